@@ -11,8 +11,15 @@
 import optparse, sys, os, marshal, subprocess, shlex
 import tempfile, os.path, time, platform
 import urllib
+import codecs
 import re
 import cStringIO
+import threading, Queue, thread
+import copy
+import heapq, itertools
+import whichdb
+import hashlib
+import fnmatch
 
 #from sets import Set
 
@@ -26,31 +33,67 @@ def die(msg):
         sys.exit(1)
 
 class LargeFileWriter:
-    """Wrapper for a file, to get around a windows bug when writing large amounts of data.
-    
-    When writing to the wrapped file object, writes are broken up so that only 10MB are written at
-    a time. Otherwise, there is IO exception on Windows.
+    """Buffered writer for the git fast-import stream.
+
+    Small writes (commands, headers) are collected and passed on to the wrapped file in one
+    go once bufferSize bytes are pending, or on flush(). Larger writes go straight through.
+    The wrapped file is only flushed on flush(), unless flushEachWrite is set.
+
+    On Windows, writes are broken up so that only 10MB are written at a time. Otherwise
+    there is an IO exception.
     """
-    def __init__(self, filedesc, debug = None):
+    def __init__(self, filedesc, debug = None, bufferSize = 1024*1024, flushEachWrite = False):
         self.read = filedesc.read
-        self.flush = filedesc.flush
-        self.close = filedesc.close
         self.filedesc = filedesc
         self.debug = debug
+        self.bufferSize = bufferSize
+        self.flushEachWrite = flushEachWrite
+        self.pending = []
+        self.pendingBytes = 0
+        # I don't know how high we can go before the bug is triggered, so we
+        # only write 10MB at a time.
+        self.chunk = 0
+        if os.name == 'nt':
+            self.chunk = 10*1024*1024
 
     def write(self, text):
-        chunk = 10*1024*1024 # I don't know how high we can go before the bug is triggered, so we
-        #only write 10MB at a time.
-        while len(text) > chunk:
-            self.filedesc.write(text[:chunk])
-            self.filedesc.flush()
-            text= text[chunk:]
+        if self.debug is not None:
+            self.debug.write(text)
 
-        if len(text):    
-            self.filedesc.write(text[:chunk])
+        if len(text) >= self.bufferSize:
+            self.writePending()
+            self.writeThrough(text)
+        else:
+            self.pending.append(text)
+            self.pendingBytes += len(text)
+            if self.pendingBytes >= self.bufferSize:
+                self.writePending()
+
+        if self.flushEachWrite:
+            self.flush()
+
+    def writePending(self):
+        if self.pending:
+            self.writeThrough(''.join(self.pending))
+            self.pending = []
+            self.pendingBytes = 0
+
+    def writeThrough(self, text):
+        if not self.chunk or len(text) <= self.chunk:
+            self.filedesc.write(text)
+            return
+        # buffer objects are slices that don't copy the rest of the text
+        for start in xrange(0, len(text), self.chunk):
+            self.filedesc.write(buffer(text, start, self.chunk))
             self.filedesc.flush()
-            if self.debug is not None:
-                self.debug.write(text[:chunk])
+
+    def flush(self):
+        self.writePending()
+        self.filedesc.flush()
+
+    def close(self):
+        self.flush()
+        self.filedesc.close()
 
 class P4Helper:
     """ Encapsulates P4 methods so that they can be replaced for testing purposes
@@ -137,6 +180,7 @@ class P4Helper:
 
     def getP4OpenedType(self, file):
         # Returns the perforce file type for the given file.
+        # p4_read_pipe doesn't go through a shell, so only the p4 wildcards are escaped
         result = self.p4_read_pipe("opened \"%s\"" % escapeStringP4only(file))
         match = re.match(".*\((.+)\)\r?", result)
         if match:
@@ -163,28 +207,33 @@ class P4Helper:
                               stdin=stdin_file,
                               stdout=subprocess.PIPE)
 
-    def p4CmdList(self, cmd, stdin=None, stdin_mode='w+b'):
-
-        p4 = self.p4CmdListOpen(cmd, stdin, stdin_mode)    
-        result = []
+    def p4CmdStream(self, cmd, stdin=None, stdin_mode='w+b', failOnError=True):
+        # Yields the records of a p4 -G command one by one as they are read, so that
+        # only one record is in memory at a time. Like p4CmdList, an error record is
+        # fatal (unless failOnError is False) and a non-zero exit code is reported as
+        # a final record with a "p4ExitCode" key.
+        p4 = self.p4CmdListOpen(cmd, stdin, stdin_mode)
         try:
             while True:
-                entry = marshal.load(p4.stdout)
-                
-                if entry['code'] == 'error':
+                try:
+                    entry = marshal.load(p4.stdout)
+                except EOFError:
+                    break
+
+                if failOnError and entry.get('code') == 'error':
                     sys.stderr.write("p4 returned an error: %s\n" % entry['data'])
                     sys.exit(1)
-                
-                result.append(entry)
-        except EOFError:
-            pass
-        exitCode = p4.wait()
+
+                yield entry
+        finally:
+            # also reached if the caller stops reading early
+            p4.stdout.close()
+            exitCode = p4.wait()
         if exitCode != 0:
-            entry = {}
-            entry["p4ExitCode"] = exitCode
-            result.append(entry)
+            yield { "p4ExitCode" : exitCode }
 
-        return result
+    def p4CmdList(self, cmd, stdin=None, stdin_mode='w+b'):
+        return list(self.p4CmdStream(cmd, stdin, stdin_mode))
 
     def p4Cmd(self, cmd):
         cmdList = self.p4CmdList(cmd)
@@ -193,6 +242,15 @@ class P4Helper:
             result.update(entry)
         return result;
 
+    def p4User(self, user):
+        # Returns the 'p4 users' record of the given user, or None if the server doesn't
+        # know it. Unlike p4CmdList, an unknown user is not a fatal error.
+        result = None
+        for entry in self.p4CmdStream("users \"%s\"" % user, failOnError=False):
+            if entry.get("User") == user:
+                result = entry
+        return result
+
     def p4Where(self, depotPath):
         if not depotPath.endswith("/"):
             depotPath += "/"
@@ -233,47 +291,163 @@ class P4Helper:
         return clientPath
 
     def p4ChangesForPaths(self, depotPaths, changeRange):
+        # Yields the numbers of the changes of the depot paths in the range in
+        # ascending order. Numeric ranges are listed in windows of change numbers
+        # with at most git-p4.changesPageSize changes each, so that the first
+        # changes are known quickly and no single query hits the server limits.
         assert depotPaths
+        bounds = self.changeRangeBounds(depotPaths, changeRange)
+        if bounds is None:
+            return self.p4AllChangesForPaths(depotPaths, changeRange)
+
+        pageSize = gitConfig("git-p4.changesPageSize")
+        if len(pageSize) > 0:
+            pageSize = max(1, int(pageSize))
+        else:
+            pageSize = 10000
+        (low, high) = bounds
+        return uniqueChanges(heapq.merge(*[self.p4ChangesPaged(p, low, high, pageSize)
+                                           for p in depotPaths]))
+
+    def p4AllChangesForPaths(self, depotPaths, changeRange):
         output = self.p4_read_pipe_lines("changes " + ' '.join (['"%s..."%s' % (p, changeRange)
                                                             for p in depotPaths]))
 
-        changes = []
+        changes = set()
         for line in output:
             changeNum = line.split(" ")[1]
-            changes.append(int(changeNum))
+            changes.add(int(changeNum))
+
+        return sorted(changes)
+
+    def changeRangeBounds(self, depotPaths, changeRange):
+        # Returns the lowest and highest change number of the range, or None if
+        # the range isn't given as change numbers (labels, dates, ...).
+        if changeRange == "":
+            (low, high) = ("1", "#head")
+        else:
+            match = re.match(r"^@(\d+),@?(\d+|#head)$", changeRange)
+            if not match:
+                return None
+            (low, high) = match.groups()
+
+        if high == "#head":
+            high = 0
+            # pending changes have higher numbers, but nothing to import yet
+            for entry in self.p4CmdList("changes -m 1 -s submitted " + ' '.join(['"%s..."' % p for p in depotPaths])):
+                if entry.has_key("change"):
+                    high = max(high, int(entry["change"]))
+        return (int(low), int(high))
+
+    def p4ChangesPaged(self, depotPath, low, high, pageSize):
+        # Yields the changes of one depot path from low to high. The window of
+        # change numbers asked for shrinks when it holds more than pageSize
+        # changes (or the server refuses the query) and grows when it is sparse.
+        window = pageSize
+        # a page with fewer changes than this is sparse; at least one, for tiny page sizes
+        sparse = max(1, pageSize / 4)
+        while low <= high:
+            top = min(high, low + window - 1)
+            changes = []
+            failed = None
+            for entry in self.p4CmdStream('changes -m %d "%s...@%d,@%d"' % (pageSize + 1, depotPath, low, top),
+                                          failOnError=False):
+                if entry.get("code") == "error":
+                    failed = entry["data"]
+                elif entry.has_key("p4ExitCode"):
+                    failed = failed or "exit code %d" % entry["p4ExitCode"]
+                elif entry.has_key("change"):
+                    changes.append(int(entry["change"]))
+
+            if (failed or len(changes) > pageSize) and top > low:
+                window = (top - low + 1) / 2
+                continue
+            if failed:
+                die("p4 changes failed for %s@%d: %s" % (depotPath, low, failed))
+
+            changes.sort()
+            for change in changes:
+                yield change
+
+            low = top + 1
+            if len(changes) < sparse:
+                window *= 2
 
-        changes.sort()
-        return changes
-        
     def integrateFile(self, diff, changelist=""):
         src, dest = diff['src'], diff['dst']
-        self.p4_system("integrate %s -Dt \"%s\" \"%s\"" % (changelist, src, escapeStringP4(dest)))
+        self.p4_system("integrate %s -Dt \"%s\" \"%s\"" % (changelist, escapeStringP4(src), escapeStringP4(dest)))
         self.p4_system("edit %s \"%s\"" % (changelist, escapeStringP4(dest)))
         os.unlink(dest)
         return dest
 
+def uniqueChanges(changes):
+    # Drops repeated changes from an ordered sequence, such as the merged change
+    # lists of several depot paths.
+    last = None
+    for change in changes:
+        if change != last:
+            yield change
+            last = change
+
+isWindows = (platform.system() == "Windows")
+
+class StringEscaper:
+    """Replaces characters by their escapes in a single pass.
+
+    Strings without any of the characters are returned as they are after one search, and
+    the results are kept in a small cache, as the same paths are escaped again and again.
+    """
+    cacheSize = 4096
+
+    def __init__(self, escapes):
+        self.escapes = escapes
+        self.pattern = re.compile("[%s]" % re.escape(''.join(escapes.keys())) if escapes else "(?!)")
+        self.cache = {}
+
+    def __call__(self, str):
+        escaped = self.cache.get(str)
+        if escaped is None:
+            escaped = str
+            if self.pattern.search(str):
+                escaped = self.pattern.sub(self.replace, str)
+            if len(self.cache) >= self.cacheSize:
+                self.cache.clear()
+            self.cache[str] = escaped
+        return escaped
+
+    def replace(self, match):
+        return self.escapes[match.group(0)]
+
+# On Windows, don't escape dollar sign
+shellEscapes = {}
+if not isWindows:
+    shellEscapes["$"] = "\\$"
+p4Escapes = { "%" : "%25", "*" : "%2A", "#" : "%23", "@" : "%40" }
+
+_escapeDollarSign = StringEscaper(shellEscapes)
+_escapeStringP4only = StringEscaper(p4Escapes)
+_escapeStringP4 = StringEscaper(dict(p4Escapes, **shellEscapes))
+_escapeString = StringEscaper(dict(shellEscapes.items() + [("*", "\\*")]))
+
 def escapeStringP4ForAdd(str):
     return escapeDollarSign(str)
 
 def escapeStringP4only(str):
     # Escape characters that have a special meaning in p4 (without normal escaping)
-    return re.sub(r"@", r"%40", re.sub(r"#", r"%23", re.sub(r"\*", r"%2A", re.sub(r"%", r"%25", str))))
+    return _escapeStringP4only(str)
 
 def escapeStringP4(str):
     # Escape characters that have a special meaning in p4 (plus the normal escaping)
-    return escapeStringP4only(escapeDollarSign(str))
+    return _escapeStringP4(str)
 
 def escapeString(str):
     # Escape dollar sign and star characters in string
     # Note: we don't need to escape parens, space and backslash if the string is enclosed in quotes
-    return re.sub(r"\*", r"\\*", escapeDollarSign(str))
+    return _escapeString(str)
 
 def escapeDollarSign(str):
     # Escape dollar sign
-    # On Windows, don't escape dollar sign
-    if (platform.system() == "Windows"):
-        return str
-    return re.sub(r"\$", r"\\$", str)
+    return _escapeDollarSign(str)
 
 def getRefsPrefix(importIntoRemotes):
     if importIntoRemotes:
@@ -285,10 +459,13 @@ def chdir(dir):
     if os.name == 'nt':
         os.environ['PWD']=dir
     os.chdir(dir)
+    refSnapshot.invalidate()
 
 def write_pipe(c, str):
     if verbose:
         sys.stderr.write('Writing pipe: %s\n' % c)
+    # e.g. git update-ref --stdin
+    refSnapshot.invalidate()
 
     pipe = os.popen(c, 'w')
     val = pipe.write(str)
@@ -334,9 +511,31 @@ def read_pipe_lines(c):
 
     return val
 
+def readCommits(revision):
+    # Yields the tree, committer and message of the commits of revision, oldest first.
+    # Only one commit object is read at a time.
+    revList = subprocess.Popen(["git", "rev-list", "--reverse", revision], stdout=subprocess.PIPE)
+    reader = subprocess.Popen(["git", "cat-file", "--batch"],
+                              stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    try:
+        for commit in revList.stdout:
+            reader.stdin.write(commit)
+            reader.stdin.flush()
+            size = int(reader.stdout.readline().split()[2])
+            (header, message) = reader.stdout.read(size + 1)[:-1].split("\n\n", 1)
+            fields = dict([line.split(" ", 1) for line in header.split("\n") if " " in line])
+            yield (fields["tree"], fields["committer"], message)
+    finally:
+        revList.stdout.close()
+        revList.wait()
+        reader.stdin.close()
+        reader.wait()
+
 def system(cmd):
     if verbose:
         sys.stderr.write("executing %s\n" % cmd)
+    # the command may change refs
+    refSnapshot.invalidate()
     if os.system(cmd) != 0:
         die("command failed: %s" % cmd)
 
@@ -388,6 +587,288 @@ def isModeExec(mode):
 def isModeExecChanged(src_mode, dst_mode):
     return isModeExec(src_mode) != isModeExec(dst_mode)
 
+class P4FileRevision(object):
+    """A file revision as it travels through the import.
+
+    Supports the dictionary style access used throughout the import (f["path"],
+    f["data"] = ..., del f["data"], f.get("mark")), but is a lot smaller than a
+    dictionary: the fields are slots, the directory part of the depot path is shared
+    between all files in the same directory, and action and type are interned. A field
+    that is not set counts as missing.
+    """
+    __slots__ = ('directory', 'name', 'rev', 'action', 'type', 'fileSize', 'target', 'data', 'mark', 'mode')
+
+    def __init__(self, path, rev, action, type, fileSize=None):
+        self.path = path
+        self.rev = rev
+        self.action = intern(action)
+        self.type = intern(type)
+        self.fileSize = fileSize
+        self.target = None
+        self.data = None
+        self.mark = None
+        self.mode = None
+
+    def getPath(self):
+        return self.directory + self.name
+
+    def setPath(self, path):
+        slash = path.rfind("/") + 1
+        self.directory = intern(path[:slash])
+        self.name = path[slash:]
+
+    path = property(getPath, setPath)
+
+    def getTargetPath(self):
+        # the target path is only stored if the tree filter changed it
+        if self.target is None:
+            return self.path
+        return self.target
+
+    def setTargetPath(self, targetPath):
+        if targetPath == self.path:
+            self.target = None
+        else:
+            self.target = targetPath
+
+    targetPath = property(getTargetPath, setTargetPath)
+
+    fields = frozenset(('path', 'rev', 'action', 'type', 'fileSize', 'targetPath', 'data', 'mark', 'mode'))
+
+    def __getitem__(self, key):
+        if key in self.fields:
+            value = getattr(self, key)
+            if value is not None:
+                return value
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in self.fields:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __delitem__(self, key):
+        self[key] = None
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def has_key(self, key):
+        return self.get(key) is not None
+
+    __contains__ = has_key
+
+    def __repr__(self):
+        return "P4FileRevision(%r, %r, %r, %r)" % (self.path, self.rev, self.action, self.type)
+
+class P4DescribeFiles(object):
+    """The file list of a "p4 describe" (or an equivalent dictionary built from
+    "p4 files"), decoded into one list per field.
+
+    p4 -G returns the files of a change as numbered keys (depotFile0, rev0, ...).
+    They are sorted into columns in a single pass over the keys, instead of probing
+    the dictionary with a formatted key for every field of every file.
+    """
+    columnNames = {
+        "depotFile": "paths",
+        "rev": "revs",
+        "action": "actions",
+        "type": "types",
+        "digest": "digests",
+        "fileSize": "fileSizes",
+    }
+
+    def __init__(self, describe):
+        columns = dict((name, {}) for name in self.columnNames)
+        for key, value in describe.iteritems():
+            name = key.rstrip("0123456789")
+            if name != key and name in columns:
+                columns[name][int(key[len(name):])] = value
+
+        count = len(columns["depotFile"])
+        for name, attribute in self.columnNames.iteritems():
+            column = columns[name]
+            setattr(self, attribute, [column.get(i) for i in xrange(count)])
+
+    def __len__(self):
+        return len(self.paths)
+
+    def fileRevision(self, i):
+        return P4FileRevision(self.paths[i], self.revs[i], self.actions[i], self.types[i],
+                              self.fileSizes[i])
+
+class DepotPathMatcher:
+    """Matches depot paths against a list of depot path prefixes, compiled once.
+
+    match() returns the first prefix the path starts with and the rest of the path,
+    percent-decoded, or None if no prefix matches or an exclude prefix does. The
+    decoded directories are cached, as most files share a few of them.
+    """
+    cacheSize = 10000
+
+    def __init__(self, prefixes, excludes=()):
+        # alternatives are tried in order, so the first matching prefix wins
+        self.pattern = re.compile("|".join([re.escape(p) for p in prefixes]) or "(?!)")
+        self.excludes = None
+        if excludes:
+            self.excludes = re.compile("|".join([re.escape(p) for p in excludes]))
+        self.decodedDirs = {}
+
+    def match(self, path):
+        if self.excludes is not None and self.excludes.match(path):
+            return None
+        m = self.pattern.match(path)
+        if m is None:
+            return None
+        return (m.group(0), self.decode(path[m.end():]))
+
+    def matches(self, path):
+        return ((self.excludes is None or not self.excludes.match(path))
+                and self.pattern.match(path) is not None)
+
+    def decode(self, relPath):
+        # paths come in percent-encoded for @,%,#,* (url-style)
+        if '%' not in relPath:
+            return relPath
+        slash = relPath.rfind('/') + 1
+        directory = relPath[:slash]
+        decoded = self.decodedDirs.get(directory)
+        if decoded is None:
+            if len(self.decodedDirs) >= self.cacheSize:
+                self.decodedDirs.clear()
+            decoded = urllib.unquote(directory)
+            self.decodedDirs[directory] = decoded
+        name = relPath[slash:]
+        if '%' in name:
+            name = urllib.unquote(name)
+        return decoded + name
+
+class P4Keywords(object):
+    """One flavour of expanded RCS keywords ($Id: //depot/file#3 $), compiled once.
+
+    collapse() turns the expanded keywords of a whole text back into $Id$ form,
+    collapser() returns a P4KeywordCollapser for text that arrives in chunks.
+    Expanded values longer than maxValueLength are not keywords, so that a '$Id:'
+    without an end only holds back that much of a text that arrives in chunks.
+    """
+    maxValueLength = 4096
+
+    def __init__(self, names, ignoreCase, stopAtNewline):
+        flags = 0
+        if ignoreCase:
+            flags = re.IGNORECASE
+        if stopAtNewline:
+            value = r'[^$\n]{0,%d}' % self.maxValueLength
+        else:
+            value = r'[^$]{0,%d}' % self.maxValueLength
+        self.pattern = re.compile(r'\$(%s):%s\$' % ('|'.join(names), value), flags)
+        self.start = re.compile(r'\$(%s):' % '|'.join(names), flags)
+        self.ignoreCase = ignoreCase
+        self.stopAtNewline = stopAtNewline
+
+        # everything a chunk can end with while still being the start of a keyword
+        self.prefixes = set()
+        for name in names:
+            name = "$" + name + ":"
+            if ignoreCase:
+                name = name.lower()
+            for i in range(1, len(name)):
+                self.prefixes.add(name[:i])
+        self.maxPrefix = max([len(p) for p in self.prefixes])
+
+    def collapse(self, text):
+        if '$' not in text:
+            return text
+        return self.pattern.sub(r'$\1$', text)
+
+    def mayBeIncomplete(self, text, i):
+        # True if the text from the '$' at position i on could still become a
+        # keyword once more text arrives.
+        match = self.start.match(text, i)
+        if match:
+            if len(text) - match.end() > self.maxValueLength:
+                return False
+            return not (self.stopAtNewline and text.find('\n', match.end()) >= 0)
+        tail = text[i:]
+        if len(tail) > self.maxPrefix:
+            return False
+        if self.ignoreCase:
+            tail = tail.lower()
+        return tail in self.prefixes
+
+    def collapser(self):
+        return P4KeywordCollapser(self)
+
+class P4KeywordCollapser(object):
+    """Collapses expanded keywords in text that is fed in chunks, with the same
+    result as P4Keywords.collapse on the whole text.
+
+    A keyword can be split between two chunks, so the text from the last '$'
+    that is not part of a keyword is held back until the next chunk (or flush())
+    if it could still turn into one.
+    """
+    def __init__(self, keywords):
+        self.keywords = keywords
+        self.pending = ''
+
+    def feed(self, data):
+        if self.pending:
+            data = self.pending + data
+            self.pending = ''
+        if '$' not in data:
+            return data
+
+        pieces = []
+        pos = 0
+        for match in self.keywords.pattern.finditer(data):
+            pieces.append(data[pos:match.start()])
+            pieces.append('$' + match.group(1) + '$')
+            pos = match.end()
+
+        last = data.rfind('$', pos)
+        if last >= 0 and self.keywords.mayBeIncomplete(data, last):
+            pieces.append(data[pos:last])
+            self.pending = data[last:]
+        else:
+            pieces.append(data[pos:])
+        return ''.join(pieces)
+
+    def flush(self):
+        data = self.pending
+        self.pending = ''
+        return self.keywords.collapse(data)
+
+# +ko files only expand $Id$ and $Header$, +k files all keywords
+koKeywords = P4Keywords(("Id", "Header"), True, False)
+kKeywords = P4Keywords(("Id", "Header", "Author", "Date", "DateTime", "Change", "File", "Revision"),
+                       False, True)
+keywordFileTypes = {
+    'text+ko': koKeywords, 'unicode+ko': koKeywords, 'binary+ko': koKeywords, 'utf16+ko': koKeywords,
+    'text+k': kKeywords, 'ktext': kKeywords, 'kxtext': kKeywords, 'unicode+k': kKeywords,
+    'binary+k': kKeywords, 'utf16+k': kKeywords,
+}
+
+def utf16FromP4Print(data, byteOrder):
+    # p4 -G print sends the contents of utf16 files as UTF-8. Converts them to
+    # UTF-16 with a byte order mark, which is what p4 writes to a workspace.
+    # Returns None if the data is neither UTF-16 nor UTF-8.
+    if data.startswith(codecs.BOM_UTF16_LE) or data.startswith(codecs.BOM_UTF16_BE):
+        return data
+    if data.startswith(codecs.BOM_UTF8):
+        data = data[len(codecs.BOM_UTF8):]
+    try:
+        text = data.decode("utf_8")
+    except UnicodeDecodeError:
+        return None
+    if not text:
+        return ""
+    if byteOrder == "big":
+        return codecs.BOM_UTF16_BE + text.encode("utf_16_be")
+    return codecs.BOM_UTF16_LE + text.encode("utf_16_le")
+
 # Some commands (eg. p4 print the entire repository) can result in gigabytes of
 # data. In order to handle this without running out of memory, we have to
 # process these items in batches of maybe 100 at a time. The P4CmdReader class
@@ -411,7 +892,7 @@ class P4CmdReader:
             raise StopIteration
 
 def currentGitBranch():
-    return read_pipe("git symbolic-ref -q HEAD")[len('refs/heads/'):].strip()
+    return refSnapshot.currentBranch()[len('refs/heads/'):]
 
 def isValidGitDir(path):
     if (os.path.exists(path + "/HEAD")
@@ -420,6 +901,9 @@ def isValidGitDir(path):
     return False
 
 def parseRevision(ref):
+    commit = refSnapshot.resolve(ref)
+    if commit is not None:
+        return commit
     if gitBranchExists(ref):
         return read_pipe("git rev-parse %s" % ref).strip()
     else:
@@ -440,13 +924,18 @@ def extractLogMessageFromGitCommit(commit):
     return logMessage
 
 def extractSettingsFromNotes(commit):
-    values = {}
     if verbose:
         print "extract settings..."
         print commit
     note = read_pipe("git notes --ref=git-p4 show %s" % commit, True)
     if verbose:
         print note
+    return parseSettingsNote(note)
+
+def parseSettingsNote(note):
+    # Returns the settings of a git-p4 note like
+    # [depot-paths = "//depot/": change = 33255: options = keepRepoPath]
+    values = {}
     m = re.search (r"^ *\[(.*)\]$", note)
     if not m:
         return values
@@ -469,53 +958,657 @@ def extractSettingsFromNotes(commit):
     return values
     
     
+class GitNotesWriter:
+    """Collects notes in memory and writes them to a notes ref with git fast-import.
+
+    Every flush creates a single notes commit, no matter how many notes were added. With a
+    batchSize > 0, the notes are flushed automatically whenever that many have been collected.
+    """
+    def __init__(self, ref="refs/notes/git-p4", batchSize=0):
+        self.ref = ref
+        self.batchSize = batchSize
+        self.notes = []
+
+    def add(self, commit, note):
+        self.notes.append((commit, note))
+        if self.batchSize > 0 and len(self.notes) >= self.batchSize:
+            self.flush()
+
+    def existingNotes(self, commits):
+        # Returns the commits that already have a note, read with a single git log
+        if not commits or not parseRevision(self.ref):
+            return set()
+        output = read_write_pipe("git log --no-walk --stdin --notes=%s --format=%%x02%%H%%x01%%N" % self.ref,
+                                 "\n".join(commits) + "\n")
+        existing = set()
+        for entry in output.split("\x02")[1:]:
+            (commit, note) = entry.split("\x01", 1)
+            if note.strip():
+                existing.add(commit)
+        return existing
+
+    def flush(self):
+        if len(self.notes) == 0:
+            return
+
+        # like 'git notes add', never overwrite a note
+        existing = self.existingNotes(set([commit for (commit, note) in self.notes]))
+        notes = [(commit, note) for (commit, note) in self.notes if commit not in existing]
+        self.notes = []
+        if len(notes) > 0:
+            self.write(notes)
+        if len(existing) > 0:
+            die("Cannot add notes to %s in %s: found existing notes"
+                % (', '.join(sorted(existing)), self.ref))
+
+    def write(self, notes):
+        message = "Notes added by git-p4 submit\n"
+        stream = cStringIO.StringIO()
+        stream.write("commit %s\n" % self.ref)
+        stream.write("committer %s\n" % read_pipe("git var GIT_COMMITTER_IDENT").strip())
+        stream.write("data %s\n%s" % (len(message), message))
+        parent = parseRevision(self.ref)
+        if parent:
+            stream.write("from %s\n" % parent)
+        for (commit, note) in notes:
+            # same content as 'git notes add -m', which terminates the message with a newline
+            note += "\n"
+            stream.write("N inline %s\n" % commit)
+            stream.write("data %s\n%s\n" % (len(note), note))
+        stream.write("\n")
+
+        if verbose:
+            sys.stderr.write("Writing %s notes to %s\n" % (len(notes), self.ref))
+        importProcess = subprocess.Popen(["git", "fast-import", "--quiet"], stdin=subprocess.PIPE)
+        importProcess.communicate(stream.getvalue())
+        stream.close()
+        refSnapshot.invalidate()
+        if importProcess.returncode != 0:
+            die("fast-import failed while writing notes to %s" % self.ref)
+
+def gitDir():
+    gitdir = os.environ.get("GIT_DIR")
+    if not gitdir:
+        gitdir = read_pipe("git rev-parse --git-dir", True).strip()
+    return gitdir
+
+class P4MetadataCache:
+    """On-disk cache of perforce metadata (users, branch and label specs, client spec).
+
+    Entries are kept in a marshalled dictionary in .git/p4/metadata-cache, shared by all syncs
+    of the repository. Every entry remembers when it was stored and an optional validator,
+    e.g. the 'Update' time the server reported for a branch spec. get() only returns an
+    entry if the validator still matches and, when a ttl is given, it is not older than that.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.entries = {}
+        self.dirty = False
+        try:
+            cache = open(self.filename, "rb")
+            try:
+                self.entries = marshal.load(cache)
+            finally:
+                cache.close()
+        except (IOError, EOFError, ValueError, TypeError):
+            # no cache yet, or it is unreadable: start over
+            self.entries = {}
+
+    def get(self, key, validator=None, ttl=None):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        (storedAt, entryValidator, value) = entry
+        if validator is not None and validator != entryValidator:
+            return None
+        if ttl is not None and time.time() - storedAt > ttl:
+            return None
+        return value
+
+    def put(self, key, value, validator=None):
+        self.entries[key] = (time.time(), validator, value)
+        self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        saveMarshalled(self.filename, self.entries)
+        self.dirty = False
+
+class P4SyncState:
+    """The settings of the last imported change of every p4 branch, kept in .git/p4/sync-state.
+
+    An entry is only used while the branch still points to the commit it was stored for, so
+    the notes don't have to be read again unless the branch was changed outside of git-p4.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.dirty = False
+        try:
+            state = open(self.filename, "rb")
+            try:
+                self.branches = marshal.load(state)
+            finally:
+                state.close()
+        except (IOError, EOFError, ValueError, TypeError):
+            self.branches = {}
+
+    def get(self, ref, commit):
+        entry = self.branches.get(ref)
+        if entry is None or entry[0] != commit:
+            return None
+        return entry[1]
+
+    def put(self, ref, commit, settings):
+        self.branches[ref] = (commit, settings)
+        self.dirty = True
+
+    def keepOnly(self, refs):
+        for ref in self.branches.keys():
+            if ref not in refs:
+                del self.branches[ref]
+                self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        saveMarshalled(self.filename, self.branches)
+        self.dirty = False
+
+def saveMarshalled(filename, value):
+    directory = os.path.dirname(filename)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    # write to a temporary file first, so that concurrent syncs never see a partial file
+    tmpName = "%s.%d" % (filename, os.getpid())
+    tmpFile = open(tmpName, "wb")
+    marshal.dump(value, tmpFile)
+    tmpFile.close()
+    if os.name == 'nt' and os.path.exists(filename):
+        os.remove(filename)
+    os.rename(tmpName, filename)
+
+def userStoreDbm():
+    # Returns a dbm module that reads single entries from disk, or None. anydbm would
+    # fall back to dumbdbm, which reads its whole index on open and loses entries when
+    # two processes write to it.
+    for name in ("dbhash", "gdbm", "dbm"):
+        try:
+            return __import__(name)
+        except ImportError:
+            pass
+    return None
+
+class P4UserStore:
+    """Maps perforce user names to "Full Name <email>", persisted in an indexed file.
+
+    Only the requested entries are read from the file, so startup cost does not depend on
+    the number of users. Users the server does not know (deleted or service accounts) are
+    remembered as negative entries and only asked for again after negativeTTL seconds.
+
+    New entries are kept in memory until flush() (or close()) writes them while holding
+    a lock file, so that two syncs of the same repository don't overwrite each other's
+    entries. Without a real dbm module the entries are kept in a text file instead,
+    which is read completely and replaced as a whole.
+    """
+    POPULATED = "\0populated"
+    LOCK_TIMEOUT = 30
+
+    def __init__(self, filename, p4, negativeTTL):
+        directory = os.path.dirname(filename)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.filename = filename
+        self.dbm = userStoreDbm()
+        if self.dbm is None:
+            self.filename += ".txt"
+        self.p4 = p4
+        self.negativeTTL = negativeTTL
+        self.pending = {}
+        self.db = None
+        self.open()
+
+    def open(self):
+        if self.dbm is None:
+            self.db = self.readText()
+            return
+        if whichdb.whichdb(self.filename) != self.dbm.__name__:
+            # new, or written by dumbdbm, whose files would hide the new ones from whichdb
+            self.lock()
+            try:
+                if whichdb.whichdb(self.filename) != self.dbm.__name__:
+                    for suffix in (".dat", ".dir", ".bak"):
+                        if os.path.exists(self.filename + suffix):
+                            os.remove(self.filename + suffix)
+                    self.dbm.open(self.filename, 'n').close()
+            finally:
+                self.unlock()
+        self.db = self.dbm.open(self.filename, 'r')
+
+    def readText(self):
+        entries = {}
+        try:
+            f = open(self.filename, "rb")
+        except IOError:
+            return entries
+        for line in f:
+            entry = line.rstrip("\n").split("\t", 1)
+            if len(entry) == 2:
+                entries[entry[0]] = entry[1]
+        f.close()
+        return entries
+
+    def lock(self):
+        lockName = self.filename + ".lock"
+        deadline = time.time() + self.LOCK_TIMEOUT
+        while True:
+            try:
+                os.close(os.open(lockName, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return
+            except OSError:
+                if time.time() > deadline:
+                    die("Timed out waiting for %s, remove it if no other git-p4 is running" % lockName)
+                time.sleep(0.1)
+
+    def unlock(self):
+        os.remove(self.filename + ".lock")
+
+    def get(self, key):
+        if key in self.pending:
+            return self.pending[key]
+        if self.db.has_key(key):
+            return self.db[key]
+        return None
+
+    def isPopulated(self):
+        return self.get(self.POPULATED) is not None
+
+    def add(self, user, value):
+        self.pending[user] = "+" + value
+
+    def update(self, users):
+        # stores a complete user list, as returned by 'p4 users'
+        for (user, value) in users.items():
+            self.add(user, value)
+        self.setPopulated()
+
+    def setPopulated(self):
+        self.pending[self.POPULATED] = str(int(time.time()))
+
+    def lookup(self, user, queryServer=True):
+        # Returns "Full Name <email>" for the given user, or None if unknown.
+        entry = self.get(user)
+        if entry is not None:
+            if entry.startswith("+"):
+                return entry[1:]
+            if not queryServer or time.time() - int(entry[1:]) < self.negativeTTL:
+                return None
+        elif not queryServer:
+            return None
+
+        output = self.p4.p4User(user)
+        if output is None:
+            self.pending[user] = "-%d" % time.time()
+            return None
+        value = output["FullName"] + " <" + output["Email"] + ">"
+        self.pending[user] = "+" + value
+        return value
+
+    def flush(self):
+        # Writes the new entries; entries other processes wrote meanwhile are kept.
+        if not self.pending:
+            return
+        self.lock()
+        try:
+            if self.dbm is None:
+                self.db = self.readText()
+                self.db.update(self.pending)
+                tmpName = "%s.%d" % (self.filename, os.getpid())
+                tmpFile = open(tmpName, "wb")
+                for (key, value) in self.db.items():
+                    tmpFile.write("%s\t%s\n" % (key, value))
+                tmpFile.close()
+                if os.name == 'nt' and os.path.exists(self.filename):
+                    os.remove(self.filename)
+                os.rename(tmpName, self.filename)
+            else:
+                self.db.close()
+                db = self.dbm.open(self.filename, 'w')
+                for (key, value) in self.pending.items():
+                    db[key] = value
+                db.close()
+                self.db = self.dbm.open(self.filename, 'r')
+        finally:
+            self.unlock()
+        self.pending = {}
+
+    def close(self):
+        self.flush()
+        if self.dbm is not None:
+            self.db.close()
+        self.db = None
+
+class P4BinaryStore:
+    """Content-addressed store for binary files that are kept out of git.
+
+    The content of a file is stored under its sha256 (objects/ab/cd/abcd...) and git gets
+    a pointer file in the format used by git-lfs instead. Submit reads the pointers back
+    to restore the real content in the perforce checkout.
+    """
+    POINTER_VERSION = "version https://git-lfs.github.com/spec/v1\n"
+    POINTER_MAX_SIZE = 1024
+    CHUNK_SIZE = 1024*1024
+
+    def __init__(self, root, threshold):
+        self.root = root
+        # only binary files larger than this are stored, smaller ones go into git
+        self.threshold = threshold
+
+    def path(self, oid):
+        return os.path.join(self.root, "objects", oid[0:2], oid[2:4], oid)
+
+    def writer(self):
+        return P4BinaryStoreWriter(self)
+
+    def pointer(self, oid, size):
+        return "%soid sha256:%s\nsize %d\n" % (self.POINTER_VERSION, oid, size)
+
+    def put(self, data):
+        # Stores data and returns the pointer to write into git instead
+        writer = self.writer()
+        writer.write(data)
+        return writer.close()
+
+    def copy(self, oid, destination):
+        # Writes the stored content to the open file destination, a chunk at a time
+        path = self.path(oid)
+        if not os.path.exists(path):
+            die("%s is missing from the binary store %s" % (oid, self.root))
+        storedFile = open(path, "rb")
+        try:
+            while True:
+                data = storedFile.read(self.CHUNK_SIZE)
+                if not data:
+                    break
+                destination.write(data)
+        finally:
+            storedFile.close()
+
+    def parsePointer(self, data):
+        # Returns the oid a pointer refers to, or None if data is not a pointer
+        if len(data) > self.POINTER_MAX_SIZE or not data.startswith(self.POINTER_VERSION):
+            return None
+        match = re.search(r"^oid sha256:([0-9a-f]{64})$", data, re.MULTILINE)
+        if match:
+            return match.group(1)
+        return None
+
+    def pointersInBlobs(self, shas):
+        # Returns a map from git blob sha1 to oid for the given blobs that are pointers
+        pointers = {}
+        shas = [sha for sha in shas if sha != "0" * 40]
+        if not shas:
+            return pointers
+        for line in read_write_pipe("git cat-file --batch-check", "\n".join(shas) + "\n").splitlines():
+            fields = line.split()
+            if len(fields) != 3 or fields[1] != "blob" or int(fields[2]) > self.POINTER_MAX_SIZE:
+                continue
+            oid = self.parsePointer(read_pipe("git cat-file blob %s" % fields[0]))
+            if oid:
+                pointers[fields[0]] = oid
+        return pointers
+
+class P4BinaryStoreWriter:
+    """Writes one object into a P4BinaryStore while its content arrives.
+
+    Like LargeFileWriter, the content is passed on as it is written instead of being
+    collected: it goes into a temporary file in the store while its sha256 is computed.
+    close() moves the file to its place and returns the pointer for git.
+    """
+    def __init__(self, store):
+        self.store = store
+        self.sha = hashlib.sha256()
+        self.size = 0
+        directory = os.path.join(store.root, "objects")
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        # the store never contains a partial object, only temporary files
+        self.tmpName = os.path.join(directory, "tmp.%d.%d" % (os.getpid(), thread.get_ident()))
+        self.file = open(self.tmpName, "wb")
+
+    def write(self, data):
+        self.sha.update(data)
+        self.size += len(data)
+        self.file.write(data)
+
+    def close(self):
+        self.file.close()
+        oid = self.sha.hexdigest()
+        path = self.store.path(oid)
+        if os.path.exists(path):
+            os.remove(self.tmpName)
+        else:
+            directory = os.path.dirname(path)
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            os.rename(self.tmpName, path)
+        return self.store.pointer(oid, self.size)
+
+def openBinaryStore():
+    # Returns the binary store configured with git-p4.binaryStore, or None
+    root = gitConfig("git-p4.binaryStore")
+    if not root:
+        return None
+    root = os.path.expanduser(root)
+    if not os.path.isabs(root):
+        root = os.path.join(os.path.abspath(gitDir()), root)
+    threshold = 0
+    if len(gitConfig("git-p4.binaryStoreThreshold")) > 0:
+        threshold = int(gitConfig("git-p4.binaryStoreThreshold"))
+    return P4BinaryStore(root, threshold)
+
+class P4BinaryPolicy:
+    """Decides which binary files are imported with their content.
+
+    The policy is a list of rules like "exclude *.psd size>10M" or "include type:ubinary".
+    A rule is "include" or "exclude" followed by conditions that all have to match:
+    a glob on the file name (or on the depot path if it contains a '/'), "type:" and a
+    glob on the p4 file type, or "size>N" / "size<N" with an optional K, M or G suffix.
+    The first matching rule decides, files no rule matches are included. Excluded files
+    are not printed at all and get imported as empty files.
+
+    Runs of rules that only match an extension ("include *.png") are merged into one
+    dictionary lookup.
+    """
+    sizeUnits = { "": 1, "k": 1024, "m": 1024 * 1024, "g": 1024 * 1024 * 1024 }
+
+    def __init__(self, rules):
+        self.steps = []
+        for rule in rules:
+            words = rule.split()
+            if len(words) < 2 or words[0] not in ("include", "exclude"):
+                die("Invalid binary policy rule: %s" % rule)
+            include = words[0] == "include"
+            extension = re.match(r"^\*(\.[^*?\[/]+)$", words[1])
+            if len(words) == 2 and extension:
+                if not self.steps or not isinstance(self.steps[-1], dict):
+                    self.steps.append({})
+                self.steps[-1].setdefault(extension.group(1).lower(), include)
+            else:
+                self.steps.append((include, [self.parseCondition(rule, word) for word in words[1:]]))
+
+    def parseCondition(self, rule, condition):
+        if condition.startswith("type:"):
+            pattern = re.compile(fnmatch.translate(condition[len("type:"):]))
+            return lambda path, type, size: pattern.match(type) is not None
+        match = re.match(r"^size([<>])(\d+)([kmg]?)$", condition, re.IGNORECASE)
+        if match:
+            limit = int(match.group(2)) * self.sizeUnits[match.group(3).lower()]
+            # files without a known size (head imports) don't match size conditions
+            if match.group(1) == ">":
+                return lambda path, type, size: size is not None and int(size) > limit
+            return lambda path, type, size: size is not None and int(size) < limit
+        if condition.startswith("size"):
+            die("Invalid size condition in binary policy rule: %s" % rule)
+        pattern = re.compile(fnmatch.translate(condition), re.IGNORECASE)
+        if "/" in condition:
+            return lambda path, type, size: pattern.match(path) is not None
+        return lambda path, type, size: pattern.match(path[path.rfind("/") + 1:]) is not None
+
+    def includes(self, path, type, size=None):
+        name = path[path.rfind("/") + 1:]
+        dot = name.rfind(".")
+        extension = None
+        if dot >= 0:
+            extension = name[dot:].lower()
+        for step in self.steps:
+            if isinstance(step, dict):
+                include = step.get(extension)
+                if include is not None:
+                    return include
+            else:
+                (include, conditions) = step
+                for condition in conditions:
+                    if not condition(path, type, size):
+                        break
+                else:
+                    return include
+        return True
+
+# without a binary store, only images are imported with their content by default;
+# like earlier versions, this includes any name ending in "tiff", not only "*.tiff"
+defaultBinaryPolicy = ["include *.jpg", "include *.jpeg", "include *.gif", "include *.png",
+                       "include *.bmp", "include *.ico", "include *.tif", "include *tiff",
+                       "exclude *"]
+
+class GitRefSnapshot:
+    """The refs of the repository, read with a single git for-each-ref.
+
+    gitBranchExists, parseRevision, p4BranchesInGit and currentGitBranch are answered from
+    it. It is invalidated by system(), chdir(), fast-import checkpoints and the end of an
+    import, and read again on the next lookup. The workers of a parallel import share it,
+    so it is only read and replaced while holding a lock.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.refs = None
+        self.head = None
+
+    def invalidate(self):
+        self.lock.acquire()
+        try:
+            self.refs = None
+            self.head = None
+        finally:
+            self.lock.release()
+
+    def load(self):
+        self.lock.acquire()
+        try:
+            if self.refs is None:
+                refs = {}
+                # outside of a repository there are no refs
+                output = read_pipe("git for-each-ref --format=\"%(objectname) %(refname)\"", True)
+                for line in output.splitlines():
+                    (commit, ref) = line.split(" ", 1)
+                    refs[ref] = commit
+                self.refs = refs
+            return self.refs
+        finally:
+            self.lock.release()
+
+    def resolve(self, name):
+        # Returns the commit a ref name points to, "" if there is no such ref, or None if
+        # the name isn't a ref name (HEAD, abbreviated ids, revision expressions).
+        if ("/" not in name and name.isupper()) or re.search(r"[~^:@{}\s]", name) or re.match(r"^[0-9a-fA-F]{4,40}$", name):
+            return None
+        refs = self.load()
+        # the same order in which git looks up ref names
+        for pattern in ("%s", "refs/%s", "refs/tags/%s", "refs/heads/%s", "refs/remotes/%s",
+                        "refs/remotes/%s/HEAD"):
+            commit = refs.get(pattern % name)
+            if commit:
+                return commit
+        return ""
+
+    def currentBranch(self):
+        self.lock.acquire()
+        try:
+            if self.head is None:
+                self.head = read_pipe("git symbolic-ref -q HEAD").strip()
+            return self.head
+        finally:
+            self.lock.release()
+
+refSnapshot = GitRefSnapshot()
+
 def gitBranchExists(branch):
+    commit = refSnapshot.resolve(branch)
+    if commit is not None:
+        return commit != ""
     proc = subprocess.Popen(["git", "rev-parse", branch],
                             stderr=subprocess.PIPE, stdout=subprocess.PIPE);
     return proc.wait() == 0;
 
 _gitConfig = {}
+# the workers of a parallel import read the configuration as well
+_gitConfigLock = threading.Lock()
+_gitVersion = None
 def gitConfig(key):
-    if not _gitConfig.has_key(key):
-        _gitConfig[key] = read_pipe("git config %s" % key, ignore_error=True).strip()
-    return _gitConfig[key]
+    _gitConfigLock.acquire()
+    try:
+        if not _gitConfig.has_key(key):
+            _gitConfig[key] = read_pipe("git config %s" % key, ignore_error=True).strip()
+        return _gitConfig[key]
+    finally:
+        _gitConfigLock.release()
+
+def gitVersion():
+    # Returns the version of git as a tuple of numbers, e.g. (1, 9, 0)
+    global _gitVersion
+    if _gitVersion is None:
+        version = read_pipe("git --version").split()[2]
+        _gitVersion = tuple([int(part) for part in re.findall(r"\d+", version)[:3]])
+    return _gitVersion
 
 def gitConfigList(key):
-    if not _gitConfig.has_key(key):
-        _gitConfig[key] = read_pipe("git config --get-all %s" % key, ignore_error=True).strip().split(os.linesep)
-    return _gitConfig[key]
+    _gitConfigLock.acquire()
+    try:
+        if not _gitConfig.has_key(key):
+            _gitConfig[key] = read_pipe("git config --get-all %s" % key, ignore_error=True).strip().split(os.linesep)
+        return _gitConfig[key]
+    finally:
+        _gitConfigLock.release()
 
 def p4BranchesInGit(branchesAreInRemotes = True):
     branches = {}
 
-    cmdline = "git rev-parse --symbolic "
-    if branchesAreInRemotes:
-        cmdline += " --remotes"
-    else:
-        cmdline += " --branches"
-
-    for line in read_pipe_lines(cmdline):
-        line = line.strip()
-
+    prefix = getRefsPrefix(branchesAreInRemotes)
+    for (ref, commit) in refSnapshot.load().items():
         ## only import to p4/
-        if not line.startswith('p4/') or line == "p4/HEAD":
+        if not ref.startswith(prefix):
+            continue
+        branch = ref[len(prefix):]
+        if branch == "HEAD":
             continue
-        branch = line
-
-        # strip off p4
-        branch = re.sub ("^p4/", "", line)
 
         # branches["master"] = parseRevision("p4/master")
-        branches[branch] = parseRevision(line) 
+        branches[branch] = commit
     return branches
 
 def findUpstreamBranchPoint(head = "HEAD"):
     branches = p4BranchesInGit()
+    # the branch tips normally have notes themselves
+    tipSettings = {}
+    if len(branches) > 0:
+        tipSettings = notesOfCommits(set(branches.values()))
     # map from depot-path to branch name
     branchByDepotPath = {}
     for branch in branches.keys():
         tip = branches[branch]
-        settings = extractLastSettingsFromNotes(tip)
+        settings = tipSettings.get(tip, {})
+        if not settings.has_key("depot-paths"):
+            settings = extractLastSettingsFromNotes(tip)
         if settings.has_key("depot-paths"):
             paths = ",".join(settings["depot-paths"])
             if branchByDepotPath.has_key(paths):
@@ -530,33 +1623,59 @@ def findUpstreamBranchPoint(head = "HEAD"):
     return ["", settings]
 
 def extractLastSettingsFromNotes(head):
-    settings = None
-    parent = 0
-    while parent < 65535:
-        commit = head + "~%s" % parent
-        settings = extractSettingsFromNotes(commit)
+    # The settings of the nearest first parent of head with a git-p4 note
+    for (commit, settings) in notesOnFirstParents(head):
         if settings.has_key("depot-paths"):
             return settings
-
-        parent = parent + 1
-
-    return settings
+    return {}
+
+def notesOnFirstParents(head):
+    # Yields (commit, settings) for head and its first parents, newest first, with the
+    # settings of their git-p4 notes ({} for commits without one), all from a single
+    # git log.
+    return gitP4Notes(["--first-parent", head])
+
+def notesOfCommits(commits):
+    # Returns the settings of the git-p4 notes of the commits, read with a single git log
+    return dict(gitP4Notes(["--no-walk"] + list(commits)))
+
+def gitP4Notes(revisions):
+    devNull = open(os.devnull, "w")
+    log = subprocess.Popen(["git", "log", "--notes=git-p4", "--format=%x01%H%n%N"] + revisions,
+                           stdout=subprocess.PIPE, stderr=devNull)
+    try:
+        commit = None
+        note = []
+        for line in log.stdout:
+            if line.startswith("\x01"):
+                if commit:
+                    yield (commit, parseSettingsNote(''.join(note).strip()))
+                commit = line[1:].strip()
+                note = []
+            else:
+                note.append(line)
+        if commit:
+            yield (commit, parseSettingsNote(''.join(note).strip()))
+    finally:
+        # also reached if the caller stops early
+        log.stdout.close()
+        log.wait()
+        devNull.close()
 
 def createOrUpdateBranchesFromOrigin(localRefPrefix = "refs/remotes/p4/", silent=True):
     if not silent:
         print ("Creating/updating branch(es) in %s based on origin branch(es)"
                % localRefPrefix)
 
-    originPrefix = "origin/p4/"
+    originPrefix = "refs/remotes/origin/p4/"
 
-    for line in read_pipe_lines("git rev-parse --symbolic --remotes"):
-        line = line.strip()
-        if (not line.startswith(originPrefix)) or line.endswith("HEAD"):
+    for ref in sorted(refSnapshot.load().keys()):
+        if (not ref.startswith(originPrefix)) or ref.endswith("HEAD"):
             continue
 
-        headName = line[len(originPrefix):]
+        headName = ref[len(originPrefix):]
         remoteHead = localRefPrefix + headName
-        originHead = line
+        originHead = ref[len("refs/remotes/"):]
 
         original = extractSettingsFromNotes(originHead)
         if (not original.has_key('depot-paths')
@@ -638,51 +1757,139 @@ class P4RollBack(Command):
 
         if self.rollbackLocalBranches:
             refPrefix = "refs/heads/"
-            lines = read_pipe_lines("git rev-parse --symbolic --branches")
         else:
-            refPrefix = "refs/remotes/"
-            lines = read_pipe_lines("git rev-parse --symbolic --remotes")
-
-        for line in lines:
-            if self.rollbackLocalBranches or (line.startswith("p4/") and line != "p4/HEAD\n"):
-                line = line.strip()
-                ref = refPrefix + line
-                settings = extractSettingsFromNotes(ref)
+            refPrefix = "refs/remotes/p4/"
 
-                depotPaths = settings['depot-paths']
-                change = settings['change']
+        updates = []
+        messages = []
+        for (ref, tip) in sorted(refSnapshot.load().items()):
+            if not ref.startswith(refPrefix) or ref == "refs/remotes/p4/HEAD":
+                continue
 
-                changed = False
+            # the notes of the first parents, from a single git log
+            walk = notesOnFirstParents(tip)
+            (target, settings) = walk.next()
+            if not settings.has_key('depot-paths'):
+                walk.close()
+                continue
 
-                if len(self.p4.p4Cmd("changes -m 1 "  + ' '.join (['%s...@%s' % (p, maxChange)
-                                                           for p in depotPaths]))) == 0:
-                    print "Branch %s did not exist at change %s, deleting." % (ref, maxChange)
-                    system("git update-ref -d %s `git rev-parse %s`" % (ref, ref))
-                    continue
+            depotPaths = settings['depot-paths']
+            change = settings.get('change')
 
-                while change and int(change) > maxChange:
-                    changed = True
-                    if self.verbose:
-                        print "%s is at %s ; rewinding towards %s" % (ref, change, maxChange)
-                    system("git update-ref %s \"%s^\"" % (ref, ref))
-                    settings = extractSettingsFromNotes(ref)
+            if len(self.p4.p4Cmd("changes -m 1 "  + ' '.join (['%s...@%s' % (p, maxChange)
+                                                       for p in depotPaths]))) == 0:
+                messages.append("Branch %s did not exist at change %s, deleted." % (ref, maxChange))
+                walk.close()
+                updates.append("delete %s %s\n" % (ref, tip))
+                continue
 
+            while change and int(change) > maxChange:
+                if self.verbose:
+                    print "%s is at %s ; rewinding towards %s" % (ref, change, maxChange)
+                try:
+                    (target, settings) = walk.next()
+                except StopIteration:
+                    die("%s has no commit before change %s" % (ref, maxChange))
+                change = settings.get('change')
+                if not change:
+                    # not imported by git-p4, so there is no telling which change it belongs to
+                    die("%s: commit %s has no git-p4 note, can't rewind %s past it" % (ref, target, ref))
+            walk.close()
+
+            if target != tip:
+                updates.append("update %s %s %s\n" % (ref, target, tip))
+                messages.append("%s rewound to %s" % (ref, change))
+
+        # all branches are updated in a single transaction, nothing is reported before it succeeded
+        if len(updates) > 0:
+            write_pipe("git update-ref --stdin", ''.join(updates))
+        for message in messages:
+            print message
 
-                    depotPaths = settings['depot-paths']
-                    change = settings['change']
+        return True
 
-                if changed:
-                    print "%s rewound to %s" % (ref, change)
+class ProgressReporter:
+    """Shows the progress of an import on a single line of the terminal.
 
-        return True
+    The line is only redrawn every interval seconds, with the current phase, the number
+    and rate of the changes, the amount and rate of the data read from p4, the time left
+    if the number of changes is known, and the file being read. When stdout is not a
+    terminal (or the import is silent) nothing is printed, but everything is still counted.
+    """
+    def __init__(self, silent=False, interval=1.0, stream=None):
+        self.stream = stream or sys.stdout
+        self.enabled = not silent and hasattr(self.stream, "isatty") and self.stream.isatty()
+        self.interval = interval
+        self.started = time.time()
+        self.lastUpdate = 0
+        self.lineLength = 0
+        self.phase = ""
+        self.total = None
+        self.changes = 0
+        self.bytes = 0
+        self.file = None
+        self.files = None
+
+    def startPhase(self, phase, total=None):
+        self.phase = phase
+        self.total = total
+        self.changes = 0
+        self.started = time.time()
+        self.update(True)
+
+    def changeDone(self, change):
+        self.changes += 1
+        self.phase = "Importing revision %s" % change
+        self.update()
+
+    def update(self, force=False):
+        if not self.enabled:
+            return
+        now = time.time()
+        if not force and now - self.lastUpdate < self.interval:
+            return
+        self.lastUpdate = now
+        elapsed = max(now - self.started, 0.001)
+
+        line = self.phase
+        if self.total:
+            line += " | %d/%d changes" % (self.changes, self.total)
+        elif self.changes:
+            line += " | %d changes" % self.changes
+        if self.changes:
+            line += ", %.1f/s" % (self.changes / elapsed)
+        line += " | %.1f MB, %.1f MB/s" % (self.bytes / 1048576.0, self.bytes / 1048576.0 / elapsed)
+        if self.total and self.changes:
+            left = int((self.total - self.changes) * elapsed / self.changes)
+            line += " | ETA %d:%02d:%02d" % (left / 3600, left / 60 % 60, left % 60)
+        if self.file:
+            name = self.file
+            if len(name) > 40:
+                name = "..." + name[-37:]
+            line += " | %s (%d/%d files)" % ((name,) + self.files)
+
+        # overwrite the whole previous line
+        self.stream.write("\r%s" % line.ljust(self.lineLength))
+        self.stream.flush()
+        self.lineLength = len(line)
+
+    def finish(self):
+        if self.enabled and self.lineLength > 0:
+            self.update(True)
+            self.stream.write("\n")
+            self.stream.flush()
+            self.lineLength = 0
+        self.file = None
 
 class P4FileReader:
-    Bytes = 0
-    LastFile = ''
-    LastBytes = 0
-    def __init__(self, files, clientSpecDirs):
+    def __init__(self, files, clientSpecDirs, binaryPolicy=None, progress=None, binaryStore=None):
         # Initialize P4FileReader object with a list of files to read. This
-        # takes into account the clientSpecDirs passed in.
+        # takes into account the clientSpecDirs passed in, and the binaryPolicy
+        # if given: binary files it excludes are not printed but returned with
+        # empty content after all other files. The bytes and files read are
+        # reported to progress, a ProgressReporter, if given. Binary files larger
+        # than the threshold of binaryStore, a P4BinaryStore, are written to it
+        # while they are printed and returned as their pointer.
         # Each element of files is a dictionary with the following
         # elements:
         #
@@ -695,12 +1902,27 @@ class P4FileReader:
         # list of files to read, filtered according to the client spec.
         self.filesToRead = []
 
-        # mapping from path to file record.
+        # binary files excluded by the binary policy.
+        self.filesSkipped = []
+
+        # mapping from depot path to file record.
         self.pathMap = {}
 
         self.filesRead = 0
 
-        self.filterClientSpec( files, clientSpecDirs )
+        self.binaryStore = binaryStore
+
+        if progress is None:
+            progress = ProgressReporter(True)
+        self.progress = progress
+
+        # utf16 revisions are converted from the print output unless
+        # git-p4.utf16PrintToFile is set, in which case p4 writes them to a temporary
+        # file with "print -o".
+        self.utf16PrintToFile = gitConfig("git-p4.utf16PrintToFile") == "true"
+        self.utf16ByteOrder = gitConfig("git-p4.utf16ByteOrder") or sys.byteorder
+
+        self.filterClientSpec( files, clientSpecDirs, binaryPolicy )
 
         self.reader = P4CmdReader('-x - print',
                              stdin='\n'.join(['%s#%s' % (f['path'], f['rev'])
@@ -709,7 +1931,7 @@ class P4FileReader:
         # leftover record from previous time next() was called.
         self.leftover = None
 
-    def filterClientSpec( self, files, clientSpecDirs ):
+    def filterClientSpec( self, files, clientSpecDirs, binaryPolicy=None ):
         # sets filesForCommit and filesToRead, filtered according to the client spec.
         for f in files:
             includeFile = False
@@ -727,22 +1949,44 @@ class P4FileReader:
             if includeFile and not excludeFile:
                 self.filesForCommit.append(f)
                 self.pathMap[f["path"]] = f
-                self.pathMap[f["targetPath"]] = f
-                if f['action'] not in ('delete', 'purge', 'move/delete'):
+                if f['action'] in ('delete', 'purge', 'move/delete'):
+                    continue
+                if (binaryPolicy is not None and f['type'].endswith('binary')
+                    and not binaryPolicy.includes(f['path'], f['type'], f.get('fileSize'))):
+                    self.filesSkipped.append(f)
+                else:
                     self.filesToRead.append(f)
 
-    def printStatus(self, filename):
-        if filename == self.LastFile and self.Bytes - self.LastBytes < 100*1024: return
-        self.LastFile = filename
-        self.LastBytes = self.Bytes
-        if len(filename) <= 60:
-            line = filename + " " * (63-len(filename))
+    def utf16Contents(self, header, data, keywords):
+        # Returns the contents of a utf16 revision as p4 would write them to a
+        # workspace, converted from the data in the print output if possible.
+        if not self.utf16PrintToFile:
+            text = utf16FromP4Print(data, self.utf16ByteOrder)
+            if text is not None:
+                return text
+
+        # Ask p4 to write the file directly.
+        # on windows, NamedTemporaryFile creates a file that is locked so we can't actually print -o to it.
+        if os.name == 'nt':
+            # create a temp file but don't delete it when it's closed
+            tmpFile = tempfile.NamedTemporaryFile(delete=False)
+            tmpFile.close()
         else:
-            line = "..." + filename[len(filename)-60:]
+            tmpFile = tempfile.NamedTemporaryFile()
 
-        print "%s | %.1f MB (%d/%d files)\r" % (line,
-            float(self.Bytes) / (1024*1024), self.filesRead + 1,
-            len(self.filesToRead)),
+        P4Helper().p4_system("print -o \"%s\" \"%s#%s\"" % (tmpFile.name, escapeStringP4(header['depotFile']), header['rev']))
+        text = open(tmpFile.name, "rb").read()
+        tmpFile.close()
+        if keywords:
+            text = keywords.collapse(text)
+        # TODO for windows, figure out how we can delete this file -- git-bash creates the files as readonly
+        return text
+
+    def printStatus(self, filename):
+        # the line is only formatted when the reporter redraws it
+        self.progress.file = filename
+        self.progress.files = (self.filesRead + 1, len(self.filesToRead))
+        self.progress.update()
 
     def __iter__(self):
         return self
@@ -767,7 +2011,10 @@ class P4FileReader:
                 try:
                     header = self.reader.next()
                 except StopIteration:
-                    print "" # newline for status information
+                    if self.filesSkipped:
+                        depotFile = self.filesSkipped.pop(0)
+                        depotFile['data'] = ""
+                        return depotFile
                     raise
 
             # now we have the header record.
@@ -776,12 +2023,30 @@ class P4FileReader:
 
             self.printStatus(header['depotFile'])
 
+            keywords = keywordFileTypes.get(header['type'])
+            collapser = None
+            if keywords:
+                collapser = keywords.collapser()
+
+            output = textBuffer
+            storeWriter = None
+            size = 0
             for record in self.reader:
                 if record['code'] in ( 'text', 'unicode', 'binary', 'utf16' ):
                     # encountered subsequent data chunk. Append to file data.
-                    textBuffer.write( record['data'] )
-                    self.Bytes += len(record['data'])
+                    self.progress.bytes += len(record['data'])
+                    if collapser:
+                        record['data'] = collapser.feed(record['data'])
+                    output.write( record['data'] )
+                    size += len(record['data'])
                     del record['data']
+                    if (storeWriter is None and self.binaryStore is not None
+                        and header['type'].endswith('binary') and size > self.binaryStore.threshold):
+                        # the rest of the file goes straight into the binary store
+                        storeWriter = self.binaryStore.writer()
+                        storeWriter.write(textBuffer.getvalue())
+                        textBuffer.truncate(0)
+                        output = storeWriter
                     self.printStatus(header['depotFile'])
                 else:
                     # encountered the next header.
@@ -789,28 +2054,16 @@ class P4FileReader:
                     self.leftover = record
                     break
 
-            if header['type'].startswith('utf16'):
-                # Don't even try to convert utf16. Ask p4 to write the file directly.
-                # on windows, NamedTemporaryFile creates a file that is locked so we can't actually print -o to it.
-                if os.name == 'nt':
-                    # create a temp file but don't delete it when it's closed
-                    tmpFile = tempfile.NamedTemporaryFile(delete=False)
-                    tmpFile.close()
-                else:
-                    tmpFile = tempfile.NamedTemporaryFile()
-
-                P4Helper().p4_system("print -o \"%s\" \"%s\"" % (tmpFile.name, escapeStringP4(header['depotFile'])))
-                text = open(tmpFile.name).read()
-                tmpFile.close()
-                # TODO for windows, figure out how we can delete this file -- git-bash creates the files as readonly
+            if collapser:
+                output.write(collapser.flush())
+            if storeWriter is not None:
+                text = storeWriter.close()
             else:
                 text = textBuffer.getvalue()
             textBuffer.close()
 
-            if header['type'] in ('text+ko', 'unicode+ko', 'binary+ko', 'utf16+ko'):
-                text = re.sub(r'(?i)\$(Id|Header):[^$]*\$',r'$\1$', text)
-            elif header['type'] in ('text+k', 'ktext', 'kxtext', 'unicode+k', 'binary+k', 'utf16+k'):
-                text = re.sub(r'\$(Id|Header|Author|Date|DateTime|Change|File|Revision):[^$\n]*\$',r'$\1$', text)
+            if header['type'].startswith('utf16'):
+                text = self.utf16Contents(header, text, keywords)
 
             depotFile = None
             filePath = header['depotFile']
@@ -825,6 +2078,54 @@ class P4FileReader:
                 continue
             
 
+def prepareCommitForSubmit(id, diffOpts):
+    # Collects everything about a git commit that submit needs and that does
+    # not depend on the state of the perforce checkout.
+    prepared = {}
+    prepared['oneline'] = read_pipe("git log --max-count=1 --pretty=oneline %s" % id)
+    prepared['diffTree'] = [parseDiffTreeEntry(line) for line in
+                            read_pipe_lines("git diff-tree -r %s \"%s^\" \"%s\"" % (diffOpts, id, id))]
+    prepared['logMessage'] = extractLogMessageFromGitCommit(id).strip()
+    prepared['diff'] = "\n".join( read_pipe_lines("git diff \"%s^\" \"%s\"" % (id, id)) )
+    return prepared
+
+class SubmitPrefetcher:
+    """Prepares upcoming commits in a background thread while the current one is submitted.
+
+    Commits are prepared strictly in the order given and handed out in that order, so the
+    order in which changelists are created does not change. At most 'depth' prepared commits
+    are kept in memory. With a depth of 0, commits are prepared on demand.
+    """
+    def __init__(self, commits, diffOpts, depth):
+        self.diffOpts = diffOpts
+        self.depth = depth
+        self.pending = list(commits)
+        if depth > 0:
+            self.queue = Queue.Queue(depth)
+            self.thread = threading.Thread(target=self.run, args=(list(commits),))
+            self.thread.setDaemon(True)
+            self.thread.start()
+
+    def run(self, commits):
+        for id in commits:
+            try:
+                self.queue.put((id, prepareCommitForSubmit(id, self.diffOpts), None))
+            except BaseException, e:
+                # die() ends up here as SystemExit; hand it to the submitting thread
+                self.queue.put((id, None, e))
+                return
+
+    def next(self, id):
+        expected = self.pending.pop(0)
+        if expected != id:
+            die("Internal error: commit %s submitted out of order (expected %s)" % (id, expected))
+        if self.depth <= 0:
+            return prepareCommitForSubmit(id, self.diffOpts)
+        (prefetchedId, prepared, error) = self.queue.get()
+        if error is not None:
+            raise error
+        return prepared
+
 class P4Submit(Command):
     def __init__(self):
         Command.__init__(self)
@@ -836,6 +2137,8 @@ class P4Submit(Command):
                 optparse.make_option("-C", dest="detectCopy", action="store_true", help="detect copies"),
                 optparse.make_option("--import-local", dest="importIntoRemotes", action="store_false",
                                      help="Import into refs/heads/ , not refs/remotes"),
+                optparse.make_option("--prefetch", dest="prefetchDepth", type="int",
+                                     help="Number of commits to prepare in the background while submitting (0 to disable)"),
         ]
         self.description = "Submit changes from git to the perforce depot."
         self.usage += " [name of git branch to submit into perforce depot]"
@@ -848,12 +2151,21 @@ class P4Submit(Command):
         if gitConfig("git-p4.detectCopy") == "true":
             self.detectCopy = True
         self.verbose = False
-        self.isWindows = (platform.system() == "Windows")
+        self.isWindows = isWindows
         self.updateP4Refs = True
         self.importIntoRemotes = True
         if gitConfig("git-p4.importIntoRemotes") == "false":
             self.importIntoRemotes = False
         self.abort = False
+        self.prefetchDepth = 2
+        if len(gitConfig("git-p4.submitPrefetch")) > 0:
+            self.prefetchDepth = int(gitConfig("git-p4.submitPrefetch"))
+        # notes are written in one notes commit per this many submitted changelists
+        self.notesBatchSize = 50
+        if len(gitConfig("git-p4.submitNotesBatchSize")) > 0:
+            self.notesBatchSize = int(gitConfig("git-p4.submitNotesBatchSize"))
+        self.binaryStore = None
+        self.binaryStorePointers = {}
 
     def check(self):
         if len(self.p4.p4CmdList("opened ...")) > 0:
@@ -913,8 +2225,25 @@ class P4Submit(Command):
 
         return template
 
-    def applyPatch(self, id):
-        diffcmd = "git format-patch -k --stdout \"%s^\"..\"%s\"" % (id, id)
+    def applyPatch(self, id, diffTree=None):
+        # files whose content lives in the binary store are not part of the patch, the
+        # perforce checkout has their real content instead of the pointers git has
+        storedFiles = {}
+        pathspec = ""
+        if self.binaryStore is not None:
+            (changedPaths, storedFiles) = self.binaryStoreFiles(id, diffTree)
+            if storedFiles:
+                if len(storedFiles) == len(changedPaths):
+                    self.restoreBinaryStoreFiles(storedFiles)
+                    return True
+                # the exclude pathspec magic was added in git 1.9
+                if gitVersion() < (1, 9):
+                    die("Submitting %s needs git 1.9 or newer: it changes files in the binary store "
+                        "together with other files" % id)
+                pathspec = " -- . " + " ".join(["\":(exclude,literal)%s\"" % escapeDollarSign(path)
+                                                 for path in storedFiles])
+
+        diffcmd = "git format-patch -k --stdout \"%s^\"..\"%s\"%s" % (id, id, pathspec)
         patchcmd = diffcmd + " | git apply "
         tryPatchCmd = patchcmd + "--check --ignore-whitespace --ignore-space-change -"
         applyPatchCmd = patchcmd + "--check --apply --ignore-whitespace --ignore-space-change -"
@@ -946,8 +2275,52 @@ class P4Submit(Command):
                     "continue afterwards with git-p4 submit --continue")
 
         system(applyPatchCmd)
+        self.restoreBinaryStoreFiles(storedFiles)
         return True
 
+    def binaryStoreFiles(self, id, diffTree=None):
+        # Returns all paths the commit changes, and a map from the paths that are (or were)
+        # binary store pointers to the git blob of their new content (None if deleted).
+        if diffTree is None:
+            diffTree = [parseDiffTreeEntry(line) for line in
+                        read_pipe_lines("git diff-tree -r %s \"%s^\" \"%s\"" % (self.diffOptions(), id, id))]
+        blobs = set()
+        for diff in diffTree:
+            blobs.add(diff['src_sha1'])
+            blobs.add(diff['dst_sha1'])
+        self.binaryStorePointers = self.binaryStore.pointersInBlobs(blobs)
+
+        changedPaths = set()
+        storedFiles = {}
+        for diff in diffTree:
+            paths = [diff['src']]
+            if diff['dst']:
+                paths.append(diff['dst'])
+            changedPaths.update(paths)
+            if diff['src_sha1'] in self.binaryStorePointers or diff['dst_sha1'] in self.binaryStorePointers:
+                for path in paths:
+                    storedFiles[path] = None
+                if diff['status'] != "D":
+                    storedFiles[paths[-1]] = diff['dst_sha1']
+        return (changedPaths, storedFiles)
+
+    def restoreBinaryStoreFiles(self, storedFiles):
+        # Writes the real content of files that are binary store pointers in git
+        for (path, blob) in storedFiles.items():
+            if blob is None:
+                continue
+            directory = os.path.dirname(path)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            if os.path.exists(path):
+                os.chmod(path, 0644)
+            storedFile = open(path, "wb")
+            if blob in self.binaryStorePointers:
+                self.binaryStore.copy(self.binaryStorePointers[blob], storedFile)
+            else:
+                storedFile.write(read_pipe("git cat-file blob %s" % blob))
+            storedFile.close()
+
     def integrateFile(self, diff, changelist=""):
         dest = self.p4.integrateFile(diff, changelist)
         if isModeExecChanged(diff['src_mode'], diff['dst_mode']):
@@ -970,7 +2343,7 @@ class P4Submit(Command):
             self.p4.p4_system("revert \"%s\"" % escapeStringP4(f));
         for f in self.filesToAdd:
             self.p4.p4_system("revert \"%s\"" % escapeStringP4(f));
-            system("rm %s" % escapeString(f))
+            os.remove(f)
 
     def setExecutableBits(self):
         # Set/clear executable bits
@@ -1044,19 +2417,21 @@ class P4Submit(Command):
             self.p4.p4_system("revert %s \"%s\"" % (changelist, escapeStringP4(f)))
             self.p4.p4_system("delete %s \"%s\"" % (changelist, escapeStringP4(f)))
 
-    def addFilesToChangelist(self, id, diffOpts):
+    def addFilesToChangelist(self, id, diffOpts, diffTree=None):
         self.filesToAdd = set()
         self.filesToDelete = set()
         self.editedFiles = set()
         self.filesToChangeExecBit = {}
-        self.getChangedFiles(diffOpts, id)
+        self.getChangedFiles(diffOpts, id, diffTree)
         for f in self.editedFiles:
             self.p4.p4_system("edit \"%s\"" % escapeStringP4(f))
 
-    def getChangedFiles(self, diffOpts, id):
-        diff = read_pipe_lines("git diff-tree -r %s \"%s^\" \"%s\"" % (diffOpts, id, id))
-        for line in diff:
-            diff = parseDiffTreeEntry(line)
+    def getChangedFiles(self, diffOpts, id, diffTree=None):
+        # diffTree holds the already parsed diff-tree entries, if the caller has them
+        if diffTree is None:
+            diffTree = [parseDiffTreeEntry(line) for line in
+                        read_pipe_lines("git diff-tree -r %s \"%s^\" \"%s\"" % (diffOpts, id, id))]
+        for diff in diffTree:
             modifier = diff['status']
             path = diff['src']
             if modifier == "M":
@@ -1085,13 +2460,18 @@ class P4Submit(Command):
                 # X (Unknown), B (pairing broken)
                 die("unknown modifier %s for %s" % (modifier, path))
 
-    def applyCommit(self, id):
-        print "Applying %s" % (read_pipe("git log --max-count=1 --pretty=oneline %s" % id))
+    def diffOptions(self):
         diffOpts = ("", "-M")[self.detectRename]
-        diffOpts = (diffOpts, "-C")[self.detectCopy]
-        self.addFilesToChangelist(id, diffOpts)
+        return (diffOpts, "-C")[self.detectCopy]
+
+    def applyCommit(self, id, prepared=None):
+        diffOpts = self.diffOptions()
+        if prepared is None:
+            prepared = prepareCommitForSubmit(id, diffOpts)
+        print "Applying %s" % prepared['oneline']
+        self.addFilesToChangelist(id, diffOpts, prepared['diffTree'])
 
-        if not self.applyPatch(id):
+        if not self.applyPatch(id, prepared['diffTree']):
             self.revertCommit()
 
         self.addOrDeleteFiles()
@@ -1099,25 +2479,43 @@ class P4Submit(Command):
         # Set/clear executable bits
         self.setExecutableBits()
 
-        logMessage = extractLogMessageFromGitCommit(id)
-        logMessage = logMessage.strip()
+        logMessage = prepared['logMessage']
 
         #diff = p4_read_pipe("diff -du ...")
         #perforce's diff -du ... breaks if one of the files has been deleted. This is a p4 bug not a git-p4 bug
-        diff = "\n".join( read_pipe_lines("git diff \"%s^\" \"%s\"" % (id, id)) )
+        diff = prepared['diff']
         template = self.prepareSubmitTemplate()
         changelist = self.submit(template, logMessage, diff)
         
         # Add note
         if changelist > 0:
-            cmd = 'git notes --ref=git-p4 add -m "[depot-paths = \\"%s\\": change = %s]" %s' % (self.depotPath, changelist, id)
-            system(cmd)
+            self.notesWriter.add(id, '[depot-paths = "%s": change = %s]' % (self.depotPath, changelist))
 
     def applyCommits(self):
-        while len(self.commits) > 0 and self.abort == False:
-            commit = self.commits[0]
-            self.commits = self.commits[1:]
-            self.applyCommit(commit)
+        self.notesWriter = GitNotesWriter("refs/notes/git-p4", self.notesBatchSize)
+        # like 'git notes add', refuse commits that already have a note, before anything
+        # is submitted
+        existing = self.notesWriter.existingNotes(self.commits)
+        if len(existing) > 0:
+            die("Cannot add notes to %s in %s: found existing notes"
+                % (', '.join(sorted(existing)), self.notesWriter.ref))
+
+        # the git side of the next commits is prepared while the current one is submitted
+        prefetcher = SubmitPrefetcher(self.commits, self.diffOptions(), self.prefetchDepth)
+        try:
+            while len(self.commits) > 0 and self.abort == False:
+                commit = self.commits[0]
+                self.commits = self.commits[1:]
+                self.applyCommit(commit, prefetcher.next(commit))
+        except:
+            # also record the changes submitted so far, then report the original error
+            error = sys.exc_info()
+            try:
+                self.notesWriter.flush()
+            except BaseException, e:
+                sys.stderr.write("Writing the notes of the submitted changes failed: %s\n" % e)
+            raise error[0], error[1], error[2]
+        self.notesWriter.flush()
 
     def sync(self, settings):
         unused = settings
@@ -1164,6 +2562,7 @@ class P4Submit(Command):
 
         print "Perforce checkout for depot path %s located at %s" % (self.depotPath, self.clientPath)
         self.oldWorkingDirectory = os.getcwd()
+        self.binaryStore = openBinaryStore()
 
         chdir(self.clientPath)
         print "Syncronizing p4 checkout..."
@@ -1191,6 +2590,75 @@ class P4Submit(Command):
 
         return True
 
+class P4RangeImporter:
+    """Imports a range of changes in a background thread, for a parallel import.
+
+    The changes are imported by a copy of the P4Sync into a temporary ref with a fast-import
+    of their own. Unless the range is the first one, the import starts with a snapshot of the
+    depot at the last change of the previous range, so that the trees of the imported commits
+    are those of a serial import. P4Sync.stitchRange then rewrites the commits on top of the
+    previous range.
+
+    The snapshot is a complete import of the depot at that change, so every range but the
+    first prints the whole depot once more. It can't start from the tree the previous range
+    ends with, as that range is imported at the same time.
+
+    The copy gets a user store and metadata cache of its own; the ref snapshot and the git
+    configuration are shared and locked.
+    """
+    def __init__(self, sync, ref, changes, baseChange):
+        self.sync = copy.copy(sync)
+        self.sync.branch = ref
+        self.sync.silent = True
+        self.sync.progress = None
+        self.sync.users = {}
+        self.sync.usersLock = threading.Lock()
+        self.sync.metadataCache = None
+        if sync.userStore is not None:
+            self.sync.userStore = P4UserStore(sync.getUserStoreFilename(), sync.p4, sync.unknownUserTTL)
+        self.sync.markCounter = 1
+        self.sync.changeListCommits = {}
+        self.sync.pendingNotes = []
+        self.sync.pendingNoteParent = ""
+        self.sync.initialParent = ""
+        self.sync.initialNoteParent = ""
+        # the notes are written when the range is stitched, never by the worker
+        self.sync.notesBatchSize = sys.maxint
+        self.ref = ref
+        self.changes = changes
+        self.baseChange = baseChange
+        self.hasBase = False
+        self.notes = []
+        self.error = None
+        self.thread = threading.Thread(target=self.run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def run(self):
+        try:
+            importProcess = subprocess.Popen(["git", "fast-import", "--quiet"], bufsize=self.sync.fastImportBufferSize,
+                                             stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            self.sync.importProcess = importProcess
+            self.sync.gitStream = LargeFileWriter(importProcess.stdin, None, self.sync.fastImportBufferSize)
+            if self.baseChange is not None:
+                self.sync.importHeadRevision("@%s" % self.baseChange)
+                self.hasBase = len(self.sync.pendingNotes) > 0
+            self.sync.importChanges(self.changes)
+            self.sync.gitStream.close()
+            if importProcess.wait() != 0:
+                die("fast-import failed")
+            self.notes = self.sync.pendingNotes
+        except BaseException, e:
+            # die() ends up here as SystemExit; hand it to the importing thread
+            self.error = e
+        self.sync.closeUserStore()
+
+    def join(self):
+        self.thread.join()
+        refSnapshot.invalidate()
+        if self.error is not None:
+            raise self.error
+
 class P4Sync(Command):
     delete_actions = ( "delete", "move/delete", "purge" )
     merge_actions = ( "branch", "integrate" )
@@ -1225,6 +2693,10 @@ class P4Sync(Command):
                                      help="Filter to apply to commit message"),
                 optparse.make_option("--content-filter", dest="contentFilter", action='store',
                                      help="Filter to apply to file content"),
+                optparse.make_option("--head-batch-size", dest="headImportBatchSize", type="int",
+                                     help="Import the head revision by printing this many files at a time"),
+                optparse.make_option("--parallel", dest="parallelImport", type="int",
+                                     help="Import the history in this many ranges of changes in parallel"),
         ]
         self.description = """Imports from Perforce into a git repository.\n
     example:
@@ -1248,13 +2720,18 @@ class P4Sync(Command):
         if gitConfig("git-p4.importIntoRemotes") == "false":
             self.importIntoRemotes = False
         self.maxChanges = ""
-        self.isWindows = (platform.system() == "Windows")
+        self.isWindows = isWindows
         self.keepRepoPath = False
         self.depotPaths = None
         self.p4BranchesInGit = []
         self.cloneExclude = []
+        self.normalizedCloneExclude = None
+        self.importMatcher = None
+        self.pathMatchers = {}
         self.useClientSpec = False
         self.fileDump = False
+        self.importProcess = None
+        self.checkpoints = 0
         self.clientSpecDirs = []
         self.markCounter = 1
         self.p4FileReader = P4FileReader
@@ -1267,6 +2744,13 @@ class P4Sync(Command):
         self.getUserList = True
         self.fuzzyTags = False
         self.changeListCommits = {} # changelist numbers and corresponding marks
+        self.pendingNotes = [] # (mark, note) of imported commits not yet written to refs/notes/git-p4
+        self.pendingNoteParent = ""
+        self.pendingNotesCommitter = ""
+        # one notes commit per this many imported changelists
+        self.notesBatchSize = 1000
+        if len(gitConfig("git-p4.syncNotesBatchSize")) > 0:
+            self.notesBatchSize = int(gitConfig("git-p4.syncNotesBatchSize"))
         self.treeFilter = ""
         self.msgFilter = ""
         self.contentFilter = ""
@@ -1274,95 +2758,132 @@ class P4Sync(Command):
 
         self.knownBranches = {}
         self.initialParents = {}
+        # highest change imported into any of the branches before this sync
+        self.lastImportedChange = 0
 
         self.lastLabelChange = 0 # changelist# of last processed label
         self.lastLabelFiles = [] # files included in last processed label
+
+        # size of the buffer for the fast-import stream, and whether it is flushed after
+        # every write ("write") or only at checkpoints and at the end ("checkpoint")
+        self.fastImportBufferSize = 1024 * 1024
+        if len(gitConfig("git-p4.fastImportBufferSize")) > 0:
+            self.fastImportBufferSize = int(gitConfig("git-p4.fastImportBufferSize"))
+        self.fastImportFlush = gitConfig("git-p4.fastImportFlush") or "checkpoint"
+        if self.fastImportFlush not in ("write", "checkpoint"):
+            die("git-p4.fastImportFlush must be \"write\" or \"checkpoint\"")
+
+        # number of ranges the history is split into and imported in parallel, 0 or 1
+        # imports serially
+        self.parallelImport = 0
+        if len(gitConfig("git-p4.parallelImport")) > 0:
+            self.parallelImport = int(gitConfig("git-p4.parallelImport"))
+
+        # 0 imports the head revision in one go, otherwise files are printed in batches
+        self.headImportBatchSize = 0
+        if len(gitConfig("git-p4.headImportBatchSize")) > 0:
+            self.headImportBatchSize = int(gitConfig("git-p4.headImportBatchSize"))
+
+        self.metadataCache = None
+        self.metadataScope = None
+        self.syncState = None
+        self.progress = None
+        self.importingChanges = False
+        self.userStore = None
+        self.usersLock = threading.Lock()
+        # binary files go to this P4BinaryStore instead of git, if git-p4.binaryStore is set
+        self.binaryStore = None
+        # decides which binary files are imported with their content
+        self.binaryPolicy = None
+        # seconds after which users unknown to the server are looked up again
+        self.unknownUserTTL = 24 * 3600
+        if len(gitConfig("git-p4.unknownUserTTL")) > 0:
+            self.unknownUserTTL = int(gitConfig("git-p4.unknownUserTTL"))
+        # seconds for which lists (users, branches, labels, client spec) are taken from the
+        # metadata cache without asking the server again
+        self.metadataCacheTTL = 300
+        if len(gitConfig("git-p4.metadataCacheTTL")) > 0:
+            self.metadataCacheTTL = int(gitConfig("git-p4.metadataCacheTTL"))
         
         if gitConfig("git-p4.syncFromOrigin") == "false":
             self.syncWithOrigin = False
 
     def extractFilesFromCommit(self, commit):
-        self.cloneExclude = [re.sub(r"\.\.\.$", "", path)
-                             for path in self.cloneExclude]
-        tmpFiles = []
-        filesString = ''
-        fnum = 0
-        while commit.has_key("depotFile%s" % fnum):
-            path = commit["depotFile%s" % fnum]
-
-            if [p for p in self.cloneExclude
-                if path.startswith (p)]:
-                found = False
-            else:
-                found = [p for p in self.depotPaths
-                         if path.startswith (p)]
-
-            if found:
-                filesString += path + '\n'
-                f = {}
-                f["path"] = path
-                f["rev"] = commit["rev%s" % fnum]
-                f["action"] = commit["action%s" % fnum]
-                f["type"] = commit["type%s" % fnum]
-                tmpFiles.append(f)
-            fnum += 1
-
+        describe = P4DescribeFiles(commit)
+        isImported = self.isImportedDepotPath
+        files = [describe.fileRevision(i) for i in xrange(len(describe))
+                 if isImported(describe.paths[i])]
+        return self.applyTreeFilter(files)
+
+    def filterDepotFiles(self, files):
+        # Drops files that are outside of the depot paths or excluded, and sets the
+        # targetPath of the remaining ones by running the tree filter.
+        isImported = self.isImportedDepotPath
+        return self.applyTreeFilter([f for f in files if isImported(f["path"])])
+
+    def isImportedDepotPath(self, path):
+        if self.cloneExclude is not self.normalizedCloneExclude:
+            # cloneExclude is set from the command line after __init__
+            self.cloneExclude = [re.sub(r"\.\.\.$", "", p)
+                                 for p in self.cloneExclude]
+            self.normalizedCloneExclude = self.cloneExclude
+        matcher = self.importMatcher
+        if (matcher is None or matcher[0] is not self.depotPaths
+            or matcher[1] is not self.cloneExclude):
+            # the depot paths are only known once the import has started
+            matcher = (self.depotPaths, self.cloneExclude,
+                       DepotPathMatcher(self.depotPaths, self.cloneExclude))
+            self.importMatcher = matcher
+        return matcher[2].matches(path)
+
+    def applyTreeFilter(self, files):
+        # Sets the targetPath of the files. Files the tree filter maps to an empty
+        # path are dropped.
+        if not self.treeFilter:
+            return files
+
+        filesString = ''.join([f["path"] + '\n' for f in files])
         filteredFiles = self.applyFilter(self.treeFilter, filesString).split('\n')
 
-        files = []
+        result = []
         i = 0
         for file in filteredFiles:
             if file:
-                f = tmpFiles[i]
+                f = files[i]
                 f["targetPath"] = file
-                files.append(f)
+                result.append(f)
             i += 1
-        return files
+        return result
 
     def stripRepoPath(self, path, prefixes):
         if self.keepRepoPath:
             prefixes = [re.sub("^(//[^/]+/).*", r'\1', prefixes[0])]
 
-        for p in prefixes:
-            if path.startswith(p):
-                path = path[len(p):]
-
-        # paths come in percent-encoded for @,%,#,* (url-style)
-        path = urllib.unquote(path)
-
-        return path
+        matcher = self.depotPathMatcher(prefixes)
+        match = matcher.match(path)
+        if match is None:
+            return matcher.decode(path)
+        return match[1]
+
+    def depotPathMatcher(self, prefixes):
+        key = tuple(prefixes)
+        matcher = self.pathMatchers.get(key)
+        if matcher is None:
+            if len(self.pathMatchers) >= 100:
+                self.pathMatchers.clear()
+            matcher = DepotPathMatcher(prefixes)
+            self.pathMatchers[key] = matcher
+        return matcher
 
     def splitFilesIntoBranches(self, commit):
-        files = []
-        filesString = ''
-        fnum = 0
-        while commit.has_key("depotFile%s" % fnum):
-            path =  commit["depotFile%s" % fnum]
-            found = [p for p in self.depotPaths
-                     if path.startswith (p)]
-
-            if found:
-                f = {}
-                f["path"] = path
-                f["rev"] = commit["rev%s" % fnum]
-                f["action"] = commit["action%s" % fnum]
-                f["type"] = commit["type%s" % fnum]
-                files.append(f)
-                filesString += path + '\n'
-            fnum += 1
-
-        filteredFiles = self.applyFilter(self.treeFilter, filesString).split('\n')
+        describe = P4DescribeFiles(commit)
+        isInDepotPaths = self.depotPathMatcher(self.depotPaths).matches
+        files = [describe.fileRevision(i) for i in xrange(len(describe))
+                 if isInDepotPaths(describe.paths[i])]
 
         branches = {}
-        i = 0
-        for targetPath in filteredFiles:
-            if not targetPath:
-                continue
-            f = files[i]
-            f["targetPath"] = targetPath
-            i += 1
-
-            relPath = self.stripRepoPath(targetPath, self.depotPaths)
+        for f in self.applyTreeFilter(files):
+            relPath = self.stripRepoPath(f["targetPath"], self.depotPaths)
 
             for branch in self.knownBranches.keys():
 
@@ -1375,77 +2896,6 @@ class P4Sync(Command):
 
         return branches
 
-    ## Should move this out, doesn't use SELF.
-    def readP4Files(self, files):
-        filesForCommit = []
-        filesToRead = []
-
-        # filter files by clientspec. Also, don't get the contents of files
-        # which we are to delete or purge.
-        for f in files:
-            includeFile = False
-            excludeFile = False
-            for val in self.clientSpecDirs:
-                if f['path'].startswith(val[0]):
-                    if val[1] > 0:
-                        includeFile = True
-                    else:
-                        excludeFile = True
-
-            if includeFile and not excludeFile:
-                filesForCommit.append(f)
-                if f['action'] not in self.delete_actions:
-                    filesToRead.append(f)
-
-        filedata = []
-        if len(filesToRead) > 0:
-            filedata = self.p4.p4CmdList('-x - print',
-                                 stdin='\n'.join(['%s#%s' % (f['path'], f['rev'])
-                                                  for f in filesToRead]),
-                                 stdin_mode='w+')
-
-            if "p4ExitCode" in filedata[0]:
-                die("Problems executing p4. Error: [%d]."
-                    % (filedata[0]['p4ExitCode']));
-
-        # Perforce outputs a number of records for each file. The first one
-        # contains basic information such as the change list and filename. This
-        # is followed by a number of records containing only "code" and "data"
-        # fields, which are the file data broken apart.
-        j = 0;
-        contents = {}
-        # for each file,
-        while j < len(filedata):
-            stat = filedata[j]
-            j += 1
-            text = ''
-            # if it's not the last file and it's code type is text, unicode, or
-            # binary,
-            while j < len(filedata) and filedata[j]['code'] in ('text', 'unicode', 'binary', 'utf16'):
-                # add the contents of the file to text.
-                # repeat for all other files.
-                text += filedata[j]['data']
-                del filedata[j]['data']
-                j += 1
-
-            if not stat.has_key('depotFile'):
-                sys.stderr.write("p4 print fails with: %s\n" % repr(stat))
-                continue
-
-            if stat['type'] in ('text+ko', 'unicode+ko', 'binary+ko', 'utf16+ko'):
-                text = re.sub(r'(?i)\$(Id|Header):[^$]*\$',r'$\1$', text)
-            elif stat['type'] in ('text+k', 'ktext', 'kxtext', 'unicode+k', 'binary+k', 'utf16+k'):
-                text = re.sub(r'\$(Id|Header|Author|Date|DateTime|Change|File|Revision):[^$\n]*\$',r'$\1$', text)
-
-            contents[stat['depotFile']] = text
-
-        for f in filesForCommit:
-            path = f['path']
-            if contents.has_key(path):
-                f['data'] = contents[path]
-
-        return filesForCommit
-
     def applyFilter(self, filter, path, cwd=os.getcwd(), env=os.environ.copy()):
         if not filter:
             return path
@@ -1517,18 +2967,15 @@ class P4Sync(Command):
 
         isMergeCommit = self.detectBranches and self.isMergeCommit(new_files)
         if isMergeCommit:
-            # make fast-import flush all changes to disk and update the refs using the checkpoint
-            # command so that we can try to find the branch parent in the git history
-            self.gitStream.write("checkpoint\n\n");
-            self.gitStream.flush();
+            # so that we can try to find the branch parent in the git history
+            self.checkpoint()
 
         self.gitStream.write("commit %s\n" % branch)
         self.gitStream.write("mark :%s\n" % self.markCounter)
         committer = ""
-        if author not in self.users and self.getUserList:
-            self.getUserMapFromPerforceServer()
-        if author in self.users:
-            committer = "%s %s %s" % (self.users[author], epoch, self.tz)
+        user = self.lookupUser(author)
+        if user is not None:
+            committer = "%s %s %s" % (user, epoch, self.tz)
         else:
             committer = "%s <a@b> %s %s" % (author, epoch, self.tz)
 
@@ -1557,7 +3004,16 @@ class P4Sync(Command):
                     else:
                         self.gitStream.write("merge %s\n" % commit)
 
-        for f in self.p4FileReader( new_files, self.clientSpecDirs ):
+        # files whose content was already written to fast-import as a blob (see
+        # importHeadRevision) are only referenced by their mark
+        storedFiles = [f for f in new_files if f.get('mark')]
+        if storedFiles:
+            filesToRead = [f for f in new_files if not f.get('mark')]
+        else:
+            filesToRead = new_files
+
+        for f in self.p4FileReader( filesToRead, self.clientSpecDirs, self.getBinaryPolicy(),
+                                    self.getProgress(), self.getBinaryStore() ):
             if f["type"] == "apple":
                 print "\nfile %s is a strange apple file that forks. Ignoring!" % f['path']
                 continue
@@ -1567,45 +3023,17 @@ class P4Sync(Command):
             if f['action'] in self.delete_actions:
                 self.gitStream.write("D %s\n" % relPath)
             else:
-                data = f['data']
-                del f['data']
-
-                mode = "644"
-                if self.p4.isP4Exec(f["type"]):
-                    mode = "755"
-                elif f["type"] == "symlink":
-                    mode = "120000"
-                    # p4 print on a symlink contains "target\n", so strip it off
-                    data = data[:-1]
-
-                if f["type"].endswith("binary") and not any(f["path"].lower().endswith(x) for x in ('.jpg','.jpeg','.gif','.png','.bmp','.ico','.tif','tiff')):
-                    data = ""
-
-                if self.isWindows and f["type"].endswith("text"):
-                    data = data.replace("\r\n", "\n")
-
+                (mode, data) = self.prepareFileData(f, relPath, details["change"])
                 if data != None:
-                    preFilterDataLen = len(data)
-                else:
-                    preFilterDataLen = 0
-
-                # apply content filter
-                if f["type"].endswith("text"):
-                    data = self.applyContentFilter(self.contentFilter, relPath, data)
-
-                if data == None:
-                    errorFile = open("git-p4-errors", "a")
-                    errorFile.write("\n# ### WARNING: data is None for file %s, type %s.\n" % (relPath, f["type"]))
-                    errorFile.write("# Prior to running filter length was: %s. Changelist #%s\n" % (preFilterDataLen, details["change"]))
-                    errorFile.write("# If this happens it might mean that p4 couldn't find the file content or that the file was stored with wrong file type in p4.\n")
-                    errorFile.write("# Try and run: p4 print \"%s#%s\"\n\n" % (f["path"], f["rev"]))
-                    errorFile.close()
-                else:
                     self.gitStream.write("M %s inline %s\n" % (mode, relPath))
                     self.gitStream.write("data %s\n" % len(data))
                     self.gitStream.write(data)
                     self.gitStream.write("\n")
 
+        for f in storedFiles:
+            relPath = self.stripRepoPath(f["targetPath"], branchPrefixes)
+            self.gitStream.write("M %s :%s %s\n" % (f['mode'], f['mark'], relPath))
+
         for f in new_files:
             includeFile = False
             excludeFile = False
@@ -1626,39 +3054,147 @@ class P4Sync(Command):
 
         self.gitStream.write("\n")
         
+        note = "[depot-paths = \"%s\": change = %s" % (','.join (branchPrefixes), details["change"])
+        if len(details['options']) > 0:
+            note += ": options = %s" % details['options']
+        note += "]"
+        self.addNote(self.markCounter, note, committer, noteParent)
+
+        localBranch = branch[len(getRefsPrefix(self.importIntoRemotes)):]
+        if not self.changeListCommits.has_key(localBranch):
+            self.changeListCommits[localBranch] = {}
+        self.changeListCommits[localBranch][change] = self.markCounter
+        self.markCounter += 1
+
+        if len(self.pendingNotes) >= self.notesBatchSize:
+            self.flushNotes()
+
+        if not self.detectBranches:
+            self.commitLabel(details, branch, change)
+
+    def prepareFileData(self, f, relPath, change):
+        # Returns the git mode and the content to import for a file read from p4,
+        # or None as content if the file can't be imported.
+        data = f['data']
+        del f['data']
+
+        mode = "644"
+        if self.p4.isP4Exec(f["type"]):
+            mode = "755"
+        elif f["type"] == "symlink":
+            mode = "120000"
+            # p4 print on a symlink contains "target\n", so strip it off
+            data = data[:-1]
+
+        if self.isWindows and f["type"].endswith("text"):
+            data = data.replace("\r\n", "\n")
+
+        if data != None:
+            preFilterDataLen = len(data)
+        else:
+            preFilterDataLen = 0
+
+        # apply content filter
+        if f["type"].endswith("text"):
+            data = self.applyContentFilter(self.contentFilter, relPath, data)
+
+        if data == None:
+            errorFile = open("git-p4-errors", "a")
+            errorFile.write("\n# ### WARNING: data is None for file %s, type %s.\n" % (relPath, f["type"]))
+            errorFile.write("# Prior to running filter length was: %s. Changelist #%s\n" % (preFilterDataLen, change))
+            errorFile.write("# If this happens it might mean that p4 couldn't find the file content or that the file was stored with wrong file type in p4.\n")
+            errorFile.write("# Try and run: p4 print \"%s#%s\"\n\n" % (f["path"], f["rev"]))
+            errorFile.close()
+
+        return (mode, data)
+
+    def writeBlobs(self, files, branchPrefixes):
+        # Reads the given files from p4 and writes them to fast-import as blobs, so that
+        # only their mark and mode need to be kept until the commit is written.
+        # Returns the files that have been stored.
+        storedFiles = []
+        for f in self.p4FileReader( files, self.clientSpecDirs, self.getBinaryPolicy(),
+                                    self.getProgress(), self.getBinaryStore() ):
+            if f["type"] == "apple":
+                print "\nfile %s is a strange apple file that forks. Ignoring!" % f['path']
+                continue
+
+            relPath = self.stripRepoPath(f["targetPath"], branchPrefixes)
+            (mode, data) = self.prepareFileData(f, relPath, "head")
+            if data == None:
+                continue
+
+            self.gitStream.write("blob\n")
+            self.gitStream.write("mark :%s\n" % self.markCounter)
+            self.gitStream.write("data %s\n" % len(data))
+            self.gitStream.write(data)
+            self.gitStream.write("\n")
+            f['mark'] = self.markCounter
+            f['mode'] = mode
+            self.markCounter += 1
+            # commit() only needs the path, action, mark and mode of a stored file
+            f.rev = f.type = f.fileSize = None
+            storedFiles.append(f)
+        return storedFiles
+
+    def addNote(self, mark, note, committer, noteParent = ""):
+        # Notes are not written right after their commit but collected and
+        # written as one notes commit by flushNotes().
+        if len(noteParent) > 0 and len(self.pendingNotes) == 0:
+            self.pendingNoteParent = noteParent
+        self.pendingNotes.append((mark, note))
+        self.pendingNotesCommitter = committer
+
+    def flushNotes(self):
+        if len(self.pendingNotes) == 0:
+            return
+
         #commit refs/notes/git-p4
-        #mark :2
         #committer <someuser@example.com> 1289238991 +0100
-        #data 21
-        #Note added by git-p4
+        #data 28
+        #Note added by git-p4 import
         #N inline :1
         #data <<EOT
         #[depot-paths = "//depot/": change = 33255]
         #EOT
         self.gitStream.write("commit refs/notes/git-p4\n")
-        self.gitStream.write("mark :%s\n" % (self.markCounter + 1))
-        self.gitStream.write("committer %s\n" % committer)
+        self.gitStream.write("committer %s\n" % self.pendingNotesCommitter)
         self.gitStream.write("data 28\n")
         self.gitStream.write("Note added by git-p4 import\n")
-        if len(noteParent) > 0:
+        if len(self.pendingNoteParent) > 0:
             if self.verbose:
-                print "note parent %s" % noteParent
-            self.gitStream.write("from %s\n" % noteParent)
-        self.gitStream.write("N inline :%s\n" % self.markCounter)
-        self.gitStream.write("data <<EOT\n[depot-paths = \"%s\": change = %s"
-                             % (','.join (branchPrefixes), details["change"]))
-        if len(details['options']) > 0:
-            self.gitStream.write(": options = %s" % details['options'])
-        self.gitStream.write("]\nEOT\n\n")
+                print "note parent %s" % self.pendingNoteParent
+            self.gitStream.write("from %s\n" % self.pendingNoteParent)
+        for (mark, note) in self.pendingNotes:
+            self.gitStream.write("N inline :%s\n" % mark)
+            self.gitStream.write("data <<EOT\n%s\nEOT\n" % note)
+        self.gitStream.write("\n")
 
-        localBranch = branch[len(getRefsPrefix(self.importIntoRemotes)):]
-        if not self.changeListCommits.has_key(localBranch):
-            self.changeListCommits[localBranch] = {}
-        self.changeListCommits[localBranch][change] = self.markCounter
-        self.markCounter += 2
+        self.pendingNotes = []
+        self.pendingNoteParent = ""
 
-        if not self.detectBranches:
-            self.commitLabel(details, branch, change)
+    def checkpoint(self):
+        # make fast-import flush all changes to disk and update the refs using the checkpoint
+        # command. The notes are needed as well to look up changes in the git history.
+        self.flushNotes()
+        self.gitStream.write("checkpoint\n\n");
+        if self.importProcess is None or self.importProcess.stdout is None:
+            self.gitStream.flush();
+            refSnapshot.invalidate()
+            return
+        # fast-import runs the checkpoint on its own time; wait until it answers the
+        # progress command that follows it, so that the refs are up to date
+        self.checkpoints += 1
+        progress = "progress git-p4 checkpoint %d" % self.checkpoints
+        self.gitStream.write(progress + "\n\n")
+        self.gitStream.flush();
+        while True:
+            line = self.importProcess.stdout.readline()
+            if not line:
+                die("fast-import failed")
+            if line.rstrip("\n") == progress:
+                break
+        refSnapshot.invalidate()
 
     def getFilesForLabel(self, label, change):
         if change == self.lastLabelChange:
@@ -1720,8 +3256,9 @@ class P4Sync(Command):
 
                     owner = labelDetails["Owner"]
                     tagger = ""
-                    if author in self.users:
-                        tagger = "%s %s %s" % (self.users[owner], epoch, self.tz)
+                    user = self.lookupUser(owner)
+                    if user is not None:
+                        tagger = "%s %s %s" % (user, epoch, self.tz)
                     else:
                         tagger = "%s <%s> %s %s" % (owner, owner, epoch, self.tz)
                     self.gitStream.write("tagger %s\n" % tagger)
@@ -1750,16 +3287,11 @@ class P4Sync(Command):
 
     def getGitCommitFromChange(self, branch, change):
         # Returns the commit where change was imported into
-        settings = None
-        parent = 0
-        while parent < 65535:
-            commit = "p4/" + branch + "~%s" % parent
-            settings = extractSettingsFromNotes(commit)
+        for (commit, settings) in notesOnFirstParents("p4/" + branch):
             if not settings:
                 return None
             if settings.has_key("change") and int(settings["change"]) == change:
                 return commit
-            parent = parent + 1
         return None
 
     def getMergeParentCommit(self, files, changeNo):
@@ -1796,53 +3328,129 @@ class P4Sync(Command):
                 highestParentChange = newChange
         return (highestParentChange, parentBranch)
 
+    def getBinaryPolicy(self):
+        if self.binaryPolicy is None:
+            rules = [rule for rule in gitConfigList("git-p4.binaryPolicy") if rule.strip()]
+            if not rules and not gitConfig("git-p4.binaryStore"):
+                rules = defaultBinaryPolicy
+            self.binaryPolicy = P4BinaryPolicy(rules)
+        return self.binaryPolicy
+
+    def getBinaryStore(self):
+        if self.binaryStore is None and gitConfig("git-p4.binaryStore"):
+            self.binaryStore = openBinaryStore()
+        return self.binaryStore
+
+    def getMetadataCache(self):
+        if self.metadataCache is None:
+            self.metadataCache = P4MetadataCache(os.path.join(gitDir(), "p4", "metadata-cache"))
+        return self.metadataCache
+
+    def p4Settings(self):
+        # Returns the server, client and user p4 commands use, as far as they are known
+        if self.metadataScope is None:
+            settings = {}
+            # p4 set also knows the values from P4CONFIG files and the registry
+            for line in read_pipe("p4 set -q", True).splitlines():
+                (name, sep, value) = line.partition("=")
+                settings[name.strip()] = value.strip()
+            self.metadataScope = (gitConfig("git-p4.port") or settings.get("P4PORT", ""),
+                                  gitConfig("git-p4.client") or settings.get("P4CLIENT", ""),
+                                  gitConfig("git-p4.user") or settings.get("P4USER", ""))
+        return self.metadataScope
+
+    def metadataKey(self, key):
+        # Cache keys include the server, client and user, so that the entries of one
+        # client or server are never used for another
+        return "%s %s %s: %s" % (self.p4Settings() + (key,))
+
+    def cachedP4CmdList(self, cmd, validator=None, ttl=None):
+        # p4CmdList, answered from the metadata cache if the entry is still valid
+        if validator is None and ttl is None:
+            ttl = self.metadataCacheTTL
+        cache = self.getMetadataCache()
+        key = self.metadataKey(cmd)
+        result = cache.get(key, validator, ttl)
+        if result is None:
+            result = self.p4.p4CmdList(cmd)
+            if not [entry for entry in result if "p4ExitCode" in entry]:
+                cache.put(key, result, validator)
+        return result
+
+    def cachedP4Cmd(self, cmd, validator=None, ttl=None):
+        result = {}
+        for entry in self.cachedP4CmdList(cmd, validator, ttl):
+            result.update(entry)
+        return result
+
     def getUserCacheFilename(self):
         home = os.environ.get("HOME", os.environ.get("USERPROFILE"))
         return home + "/.gitp4-usercache.txt"
 
+    def getUserStoreFilename(self):
+        return os.path.join(gitDir(), "p4", "users")
+
     def getUserMapFromPerforceServer(self):
+        # Fills the user store with the complete user list of the server
         if self.userMapFromPerforceServer:
             return
-        self.users = {}
+        self.userMapFromPerforceServer = True
 
-        for output in self.p4.p4CmdList("users"):
+        # users go straight into the store; they are read back from there when needed
+        for output in self.p4.p4CmdStream("users"):
             if not output.has_key("User"):
                 continue
-            self.users[output["User"]] = output["FullName"] + " <" + output["Email"] + ">"
-
-
-        s = ''
-        for (key, val) in self.users.items():
-            s += "%s\t%s\n" % (key, val)
-
-        open(self.getUserCacheFilename(), "wb").write(s)
-        self.userMapFromPerforceServer = True
+            self.userStore.add(output["User"], output["FullName"] + " <" + output["Email"] + ">")
+        self.userStore.setPopulated()
+        self.users = {}
 
     def loadUserMapFromCache(self):
         self.users = {}
         self.userMapFromPerforceServer = False
+        self.userStore = P4UserStore(self.getUserStoreFilename(), self.p4, self.unknownUserTTL)
+        if self.userStore.isPopulated():
+            return
+
+        # first sync into this repository: take the users from the cache file written by
+        # earlier versions, or get all of them at once from the server.
+        users = {}
         try:
             cache = open(self.getUserCacheFilename(), "rb")
             lines = cache.readlines()
             cache.close()
             for line in lines:
                 entry = line.strip().split("\t")
-                self.users[entry[0]] = entry[1]
+                users[entry[0]] = entry[1]
         except IOError:
             if self.verbose:
-                print "IO Error processing line %s" % line
-            if self.getUserList:
-                self.getUserMapFromPerforceServer()
+                print "IO Error reading %s" % self.getUserCacheFilename()
+            users = {}
         except IndexError:
             if self.verbose:
                 print "Index Error processing line %s" % line
-            if self.getUserList:
-                self.getUserMapFromPerforceServer()
+            users = {}
+
+        if len(users) > 0:
+            self.userStore.update(users)
+        elif self.getUserList:
+            self.getUserMapFromPerforceServer()
+
+    def lookupUser(self, user):
+        # Returns "Full Name <email>" for a perforce user, or None if it is unknown.
+        # Users not yet looked up are asked for individually (see P4UserStore).
+        # The lock is shared with the copies a parallel import works with.
+        self.usersLock.acquire()
+        try:
+            if user not in self.users and self.userStore is not None:
+                self.users[user] = self.userStore.lookup(user, self.getUserList)
+            return self.users.get(user)
+        finally:
+            self.usersLock.release()
 
     def getLabels(self):
         self.labels = {}
 
-        l = self.p4.p4CmdList("labels %s..." % ' '.join (self.depotPaths))
+        l = self.cachedP4CmdList("labels %s..." % ' '.join (self.depotPaths), ttl=self.metadataCacheTTL)
         if len(l) > 0 and not self.silent:
             print "Finding files belonging to labels in %s" % `self.depotPaths`
 
@@ -1852,7 +3460,8 @@ class P4Sync(Command):
                                  % output['data'])
                 sys.exit(1)
             label = output["label"]
-            details = self.p4.p4Cmd("label -o \"%s\"" % label)
+            # the label spec and its files only need to be fetched again if the label changed
+            details = self.cachedP4Cmd("label -o \"%s\"" % label, output.get("Update"))
             viewIdx = 0
             views = []
             while details.has_key("View%s" % viewIdx):
@@ -1860,17 +3469,29 @@ class P4Sync(Command):
                 viewIdx = viewIdx + 1
                 output["Views"] = views
 
-            revisions = {}
-            newestChange = 0
-            if self.verbose:
-                print "Querying files for label %s" % label
-            for f in self.p4.p4CmdList("files "
-                                  +  ' '.join (['"%s...@%s"' % (p, label)
-                                                for p in self.depotPaths])):
-                revisions[f["depotFile"]] = f["rev"]
-                change = int(f["change"])
-                if change > newestChange:
-                    newestChange = change
+            # cache the file revisions of the label rather than the 'p4 files' records,
+            # in a file of its own so that a sync only reads the labels it needs
+            filesCmd = "files " + ' '.join (['"%s...@%s"' % (p, label) for p in self.depotPaths])
+            key = self.metadataKey(filesCmd)
+            cache = P4MetadataCache(os.path.join(gitDir(), "p4", "labels",
+                                                 hashlib.sha1(key).hexdigest()))
+            cached = cache.get(key, output.get("Update"), self.metadataCacheTTL)
+            if cached is not None:
+                (revisions, newestChange) = cached
+            else:
+                revisions = {}
+                newestChange = 0
+                if self.verbose:
+                    print "Querying files for label %s" % label
+                for f in self.p4.p4CmdStream(filesCmd):
+                    if 'p4ExitCode' in f:
+                        die("Problems executing p4. Error: [%d]." % f['p4ExitCode'])
+                    revisions[f["depotFile"]] = f["rev"]
+                    change = int(f["change"])
+                    if change > newestChange:
+                        newestChange = change
+                cache.put(key, (revisions, newestChange), output.get("Update"))
+                cache.save()
 
             self.labels[newestChange] = [output, revisions]
 
@@ -1896,8 +3517,9 @@ class P4Sync(Command):
         else:
             command = "branches"
 
-        for info in self.p4.p4CmdList(command):
-            details = self.p4.p4Cmd("branch -o \"%s\"" % info["branch"])
+        for info in self.cachedP4CmdList(command, ttl=self.metadataCacheTTL):
+            # the branch spec only needs to be fetched again if the branch changed
+            details = self.cachedP4Cmd("branch -o \"%s\"" % info["branch"], info.get("Update"))
             viewIdx = 0
             while details.has_key("View%s" % viewIdx):
                 paths = details["View%s" % viewIdx].split(" ")
@@ -2028,15 +3650,13 @@ class P4Sync(Command):
         return ""
 
     def importNewBranch(self, branch, maxChange):
-        # make fast-import flush all changes to disk and update the refs using the checkpoint
-        # command so that we can try to find the branch parent in the git history
-        self.gitStream.write("checkpoint\n\n");
-        self.gitStream.flush();
+        # so that we can try to find the branch parent in the git history
+        self.checkpoint()
         branchPrefix = self.depotPaths[0] + branch + "/"
         commitRange = "@1,%s" % maxChange
         if self.verbose:
             print "!!!!prefix" + branchPrefix
-        changes = self.p4.p4ChangesForPaths([branchPrefix], commitRange)
+        changes = list(self.p4.p4ChangesForPaths([branchPrefix], commitRange))
         if len(changes) <= 0:
             return False
         firstChange = changes[0]
@@ -2059,15 +3679,31 @@ class P4Sync(Command):
         return True
 
     def importChanges(self, changes, restartImport = False):
+        # changes can also be an iterator whose length isn't known yet
+        total = None
+        if hasattr(changes, "__len__"):
+            total = len(changes)
+        # new branches are imported by nested calls, which count towards the same progress
+        nested = self.importingChanges
+        progress = self.getProgress()
+        if not nested:
+            progress.startPhase("Importing changes", total)
+        self.importingChanges = True
+        try:
+            self.importChangeList(changes, restartImport, progress)
+        finally:
+            self.importingChanges = nested
+        if not nested:
+            progress.finish()
+
+    def importChangeList(self, changes, restartImport, progress):
         cnt = 0
         for change in changes:
             description = self.p4.p4Cmd("describe -s %s" % change)
             self.updateOptionDict(description)
 
             cnt = cnt + 1
-            if not self.silent:
-                sys.stdout.write("\rImporting revision %s (%s%%)\n" % (change, cnt * 100 / len(changes)))
-                sys.stdout.flush()
+            progress.changeDone(change)
 
             if self.detectBranches:
                 branches = self.splitFilesIntoBranches(description)
@@ -2140,94 +3776,248 @@ class P4Sync(Command):
                 self.initialParent = ""
                 self.initialNoteParent = ""
 
-    def importHeadRevision(self, revision):
-        print "Doing initial import of %s from revision %s into %s" % (' '.join(self.depotPaths), revision, self.branch)
+    def canImportInParallel(self, changes):
+        if self.parallelImport <= 1 or len(changes) < 2 * self.parallelImport:
+            return False
+        # the ranges are imported independently, which only works for a fresh import of
+        # a single branch
+        if (self.detectBranches or self.detectLabels or self.initialParent or self.restartImport
+            or self.fileDump or self.contentFilter):
+            if not self.silent:
+                print "Parallel import only works for new imports without branch or label detection, file dumps and content filters; importing serially"
+            return False
+        return True
 
+    def importChangesInParallel(self, changes):
+        # Imports ranges of the changes in parallel and stitches them together into the
+        # same history a serial import creates.
+        count = self.parallelImport
+        size = (len(changes) + count - 1) / count
+        ranges = [changes[i:i + size] for i in range(0, len(changes), size)]
+        if not self.silent:
+            print "Importing %d changes in %d ranges in parallel" % (len(changes), len(ranges))
+
+        # the workers open the user store again and should find all users known so far
+        if self.userStore is not None:
+            self.userStore.flush()
+
+        importers = []
+        baseChange = None
+        for i in range(len(ranges)):
+            ref = "refs/git-p4-parallel/%d" % i
+            if gitBranchExists(ref):
+                system("git update-ref -d %s" % ref)
+            importers.append(P4RangeImporter(self, ref, ranges[i], baseChange))
+            baseChange = ranges[i][-1]
+
+        tree = None
+        for importer in importers:
+            importer.join()
+            tree = self.stitchRange(importer, tree)
+            if gitBranchExists(importer.ref):
+                system("git update-ref -d %s" % importer.ref)
+
+    def stitchRange(self, importer, tree):
+        # Writes the commits of a range imported by a P4RangeImporter to self.branch, with
+        # the tree, committer and message of the imported commits. tree is the tree of the
+        # last commit written so far. Returns the tree of the last commit written.
+        count = 0
+        if gitBranchExists(importer.ref):
+            count = int(read_pipe("git rev-list --count %s" % importer.ref))
+        # the commits are read one at a time while they are written
+        commits = readCommits(importer.ref)
+        try:
+            baseTree = None
+            notes = importer.notes
+            if importer.hasBase:
+                baseTree = commits.next()[0]
+                count -= 1
+                notes = notes[1:]
+
+            if baseTree != tree or count != len(notes):
+                # the snapshot the range started from is not what the previous ranges ended
+                # with, so its commits can't be used
+                if not self.silent:
+                    print "Importing changes %s to %s serially" % (importer.changes[0], importer.changes[-1])
+                self.importChanges(importer.changes)
+                self.checkpoint()
+                if not gitBranchExists(self.branch):
+                    return tree
+                return read_pipe("git rev-parse %s^{tree}" % self.branch).strip()
+
+            emptyTree = "4b825dc642cb6eb9a060e54bf8d69288fbee4904"
+            for ((mark, note), (tree, committer, message)) in itertools.izip(notes, commits):
+                self.gitStream.write("commit %s\n" % self.branch)
+                self.gitStream.write("mark :%s\n" % self.markCounter)
+                self.gitStream.write("committer %s\n" % committer)
+                self.gitStream.write("data %s\n" % len(message))
+                self.gitStream.write(message)
+                self.gitStream.write("\n")
+                if tree == emptyTree:
+                    self.gitStream.write("deleteall\n")
+                else:
+                    self.gitStream.write("M 040000 %s \"\"\n" % tree)
+                self.gitStream.write("\n")
+
+                self.addNote(self.markCounter, note, committer, self.initialNoteParent)
+                self.initialNoteParent = ""
+                self.markCounter += 1
+                if len(self.pendingNotes) >= self.notesBatchSize:
+                    self.flushNotes()
+            return tree
+        finally:
+            commits.close()
+
+    def checkHeadFileInfo(self, info):
+        if 'code' in info and info['code'] == 'error':
+            sys.stderr.write("p4 returned an error: %s\n"
+                             % info['data'])
+            if info['data'].find("must refer to client") >= 0:
+                sys.stderr.write("This particular p4 error is misleading.\n")
+                sys.stderr.write("Perhaps the depot path was misspelled.\n");
+                sys.stderr.write("Depot path:  %s\n" % " ".join(self.depotPaths))
+            sys.exit(1)
+        if 'p4ExitCode' in info:
+            sys.stderr.write("p4 exitcode: %s\n" % info['p4ExitCode'])
+            sys.exit(1)
+
+    def headRevisionDetails(self, revision, newestRevision):
         details = {}
         details["user"] = "git perforce import user"
         details["desc"] = ("Initial import of %s from the state at revision %s"
                            % (' '.join(self.depotPaths), revision))
-        details["change"] = revision
-        newestRevision = 0
+        details["change"] = newestRevision
+
+        # Use time from top-most change so that all git-p4 clones of
+        # the same p4 repo have the same commit SHA1s.
+        newestTime = None
+        for r in self.p4.p4CmdStream("describe -s %d" % newestRevision):
+            if r.has_key('time'):
+                newestTime = int(r['time'])
+        if newestTime is None:
+            die("\"describe -s\" on newest change %d did not give a time" % newestRevision)
+        details["time"] = newestTime
 
-        fileCnt = 0
-        for info in self.p4.p4CmdList("files "
-                              +  ' '.join(["%s...%s"
-                                           % (p, revision)
-                                           for p in self.depotPaths])):
+        self.updateOptionDict(details)
+        return details
 
-            if 'code' in info and info['code'] == 'error':
-                sys.stderr.write("p4 returned an error: %s\n"
-                                 % info['data'])
-                if info['data'].find("must refer to client") >= 0:
-                    sys.stderr.write("This particular p4 error is misleading.\n")
-                    sys.stderr.write("Perhaps the depot path was misspelled.\n");
-                    sys.stderr.write("Depot path:  %s\n" % " ".join(self.depotPaths))
-                sys.exit(1)
-            if 'p4ExitCode' in info:
-                sys.stderr.write("p4 exitcode: %s\n" % info['p4ExitCode'])
-                sys.exit(1)
+    def importHeadRevision(self, revision):
+        if self.headImportBatchSize > 0:
+            return self.importHeadRevisionInBatches(revision)
 
+        if not self.silent:
+            print "Doing initial import of %s from revision %s into %s" % (' '.join(self.depotPaths), revision, self.branch)
+
+        # The file list is consumed as it arrives and only a P4FileRevision of every
+        # imported file is kept. All of them are still in memory until the commit is
+        # written; --head-batch-size also limits that.
+        newestRevision = 0
+        files = []
+        for info in self.p4.p4CmdStream("files "
+                                        +  ' '.join(["%s...%s"
+                                                     % (p, revision)
+                                                     for p in self.depotPaths]),
+                                        failOnError=False):
+            self.checkHeadFileInfo(info)
 
             change = int(info["change"])
             if change > newestRevision:
                 newestRevision = change
 
             if info["action"] in self.delete_actions:
-                # don't increase the file cnt, otherwise details["depotFile123"] will have gaps!
-                #fileCnt = fileCnt + 1
                 continue
 
-            for prop in ["depotFile", "rev", "action", "type" ]:
-                details["%s%s" % (prop, fileCnt)] = info[prop]
+            files.extend(self.filterDepotFiles([P4FileRevision(info["depotFile"], info["rev"],
+                                                               info["action"], info["type"])]))
 
-            fileCnt = fileCnt + 1
+        details = self.headRevisionDetails(revision, newestRevision)
+        self.commit(details, files, self.branch, self.depotPaths)
 
-        details["change"] = newestRevision
+    def importHeadRevisionInBatches(self, revision):
+        # Same result as importHeadRevision, but the file list is streamed and the files
+        # are printed and written to fast-import as blobs in batches of headImportBatchSize.
+        # Until the commit is written, only the path, mark and mode of every file are kept.
+        if not self.silent:
+            print "Doing initial import of %s from revision %s into %s in batches of %s files" % (
+                ' '.join(self.depotPaths), revision, self.branch, self.headImportBatchSize)
 
-        # Use time from top-most change so that all git-p4 clones of
-        # the same p4 repo have the same commit SHA1s.
-        res = self.p4.p4CmdList("describe -s %d" % newestRevision)
-        newestTime = None
-        for r in res:
-            if r.has_key('time'):
-                newestTime = int(r['time'])
-        if newestTime is None:
-            die("\"describe -s\" on newest change %d did not give a time")
-        details["time"] = newestTime
+        newestRevision = 0
+        files = []
+        batch = []
+        for info in self.p4.p4CmdStream("files "
+                                        +  ' '.join(["%s...%s"
+                                                     % (p, revision)
+                                                     for p in self.depotPaths]),
+                                        failOnError=False):
+            self.checkHeadFileInfo(info)
 
-        self.updateOptionDict(details)
-        self.commit(details, self.extractFilesFromCommit(details), self.branch, self.depotPaths)
+            change = int(info["change"])
+            if change > newestRevision:
+                newestRevision = change
+
+            if info["action"] in self.delete_actions:
+                continue
+
+            batch.append(P4FileRevision(info["depotFile"], info["rev"], info["action"], info["type"]))
+            if len(batch) >= self.headImportBatchSize:
+                files.extend(self.writeBlobs(self.filterDepotFiles(batch), self.depotPaths))
+                batch = []
+        files.extend(self.writeBlobs(self.filterDepotFiles(batch), self.depotPaths))
 
+        details = self.headRevisionDetails(revision, newestRevision)
+        self.commit(details, files, self.branch, self.depotPaths)
 
     def getClientSpec(self):
         # fill in self.clientSpecDirs, with a map from folder names to an
         # integer. If the integer is positive, the folder name maps to its
         # length. If the integer is negative, the folder name maps to its
         # negative length, and was explicitly excluded.
-        specList = self.p4.p4CmdList( "client -o" )
+
+        # The view is only read again when the client has been changed. Its update time
+        # comes from 'clients -e', which is cheaper than reading the spec; without a
+        # known client name the spec is read every time.
+        cache = self.getMetadataCache()
+        key = self.metadataKey("client spec dirs")
+        name = self.p4Settings()[1]
+        update = None
+        if name:
+            for entry in self.p4.p4CmdList('clients -e "%s"' % name):
+                if entry.get("client") == name:
+                    update = entry.get("Update")
+        if update is not None:
+            self.clientSpecDirs = cache.get(key, update)
+            if self.clientSpecDirs is not None:
+                return
+
+        spec = {}
+        for entry in self.p4.p4CmdStream( "client -o" ):
+            if 'p4ExitCode' in entry:
+                die("Problems executing p4. Error: [%d]." % entry['p4ExitCode'])
+            spec.update(entry)
+
         temp = {}
-        for entry in specList:
-            for k,v in entry.iteritems():
-                if k.startswith("View"):
-                    if v.startswith('"'):
-                        start = 1
-                    else:
-                        start = 0
-                    index = v.find("...")
-                    v = v[start:index]
-                    if v.startswith("-"):
-                        v = v[1:]
-                        temp[v] = -len(v)
-                    else:
-                        temp[v] = len(v)
+        for k,v in spec.iteritems():
+            if k.startswith("View"):
+                if v.startswith('"'):
+                    start = 1
+                else:
+                    start = 0
+                index = v.find("...")
+                v = v[start:index]
+                if v.startswith("-"):
+                    v = v[1:]
+                    temp[v] = -len(v)
+                else:
+                    temp[v] = len(v)
         self.clientSpecDirs = temp.items()
         self.clientSpecDirs.sort( lambda x, y: abs( y[1] ) - abs( x[1] ) )
+        if update is not None:
+            cache.put(key, self.clientSpecDirs, update)
 
     def CalculateLastImportedP4ChangeList(self):
         p4Change = 0
         for branch in self.p4BranchesInGit:
-            settings = extractSettingsFromNotes(self.refPrefix + branch)
+            settings = self.settingsForBranch(self.refPrefix + branch)
             if self.verbose:
                 print "settings:"
                 print self.refPrefix + branch
@@ -2242,23 +4032,55 @@ class P4Sync(Command):
                 if self.previousDepotPaths == []:
                     self.previousDepotPaths = depotPaths
                 else:
-                    paths = []
-                    for (prev, cur) in zip(self.previousDepotPaths, depotPaths):
-                        for i in range(0, min(len(cur), len(prev))):
-                            if cur[i] <> prev[i]:
-                                i = i - 1
-                                break
+                    self.previousDepotPaths = [os.path.commonprefix([prev, cur])
+                                               for (prev, cur) in zip(self.previousDepotPaths, depotPaths)]
 
-                        paths.append (cur[:i + 1])
-
-                    self.previousDepotPaths = paths
+        self.getSyncState().save()
 
         if p4Change > 0:
             self.depotPaths = sorted(self.previousDepotPaths)
             self.changeRange = "@%s,#head" % p4Change
+            self.lastImportedChange = p4Change - 1
             if not self.silent and not self.detectBranches:
                 print "Performing incremental import into %s git branch" % self.branch
         
+    def getProgress(self):
+        # created on first use, after the options (--silent) have been parsed
+        if self.progress is None:
+            self.progress = ProgressReporter(self.silent)
+        return self.progress
+
+    def getSyncState(self):
+        if self.syncState is None:
+            self.syncState = P4SyncState(os.path.join(gitDir(), "p4", "sync-state"))
+        return self.syncState
+
+    def settingsForBranch(self, ref):
+        # The settings of the last change imported into the branch, from the sync state
+        # if the branch hasn't moved since, otherwise from its git-p4 note.
+        commit = self.initialParents[ref]
+        settings = self.getSyncState().get(ref, commit)
+        if settings is None:
+            settings = extractSettingsFromNotes(ref)
+            if settings:
+                self.syncState.put(ref, commit, settings)
+        return settings
+
+    def saveSyncState(self):
+        # Remembers the settings of all branch tips for the next sync
+        state = self.getSyncState()
+        branches = p4BranchesInGit(self.importIntoRemotes)
+        refs = set()
+        for (branch, commit) in branches.items():
+            ref = self.refPrefix + branch
+            refs.add(ref)
+            if state.get(ref, commit) is None:
+                settings = extractSettingsFromNotes(commit)
+                if settings:
+                    state.put(ref, commit, settings)
+        state.keepOnly(refs)
+        state.save()
+
     def adjustDepotPaths(self):
         revision = ""
         newPaths = []
@@ -2309,11 +4131,20 @@ class P4Sync(Command):
                 b = b[len(self.projectName):]
             self.createdBranches.add(b)
 
+    def closeUserStore(self):
+        if self.userStore is not None:
+            self.userStore.close()
+            self.userStore = None
+
     def cleanup(self):
+        self.closeUserStore()
         if self.contentFilterDir:
             system("rm -rf %s" % self.contentFilterDir)
 
-    def run(self, args):
+    def prepareImport(self, args):
+        # Everything up to the start of the import: finds the branches and the changes
+        # imported so far, reads users, labels and the client spec and starts fast-import.
+        # Returns the revision to import if only a single revision is imported.
         if self.debug:
             self.verbose = True
 
@@ -2402,29 +4233,39 @@ class P4Sync(Command):
 
         if self.detectBranches:
             self.detectP4Branches()
-        
+
+        self.getMetadataCache().save()
+
         self.tz = "%+03d%02d" % (- time.timezone / 3600, ((- time.timezone % 3600) / 60))
 
+        self.debugDumpFile = None
         if self.fileDump:
             self.gitStream = open("git-p4-dump", "wb")
         else:
             if self.debug:
                 tmpfile = "%s/p4import" % tempfile.gettempdir()
                 print "Writing input for 'git fast-import' to %s\n" % tmpfile
-                debugDumpFile = open(tmpfile, "w")
-            else:
-                debugDumpFile = None
+                self.debugDumpFile = open(tmpfile, "w")
 
             fastImportCmd = ["git", "fast-import"]
             if not self.verbose:
                 fastImportCmd.append("--quiet")
-            importProcess = subprocess.Popen(fastImportCmd,
-                                             stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-            self.gitStream = LargeFileWriter(importProcess.stdin, debugDumpFile)
+            self.importProcess = subprocess.Popen(fastImportCmd, bufsize=self.fastImportBufferSize,
+                                                  stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            self.gitStream = LargeFileWriter(self.importProcess.stdin, self.debugDumpFile,
+                                             self.fastImportBufferSize, self.fastImportFlush == "write")
+
+        self.updatedBranches = set()
+        return revision
+
+    def run(self, args):
+        revision = self.prepareImport(args)
 
         try:
             if revision:
+                self.getProgress().startPhase("Importing revision %s" % revision)
                 self.importHeadRevision(revision)
+                self.getProgress().finish()
             else:
                 changes = []
 
@@ -2442,27 +4283,35 @@ class P4Sync(Command):
                     print "Getting p4 changes for %s...%s" % (', '.join(self.depotPaths),
                                                                   self.changeRange)
                     changes = self.p4.p4ChangesForPaths(self.depotPaths, self.changeRange)
-                    if self.verbose:
-                        print "Found %i changes" % len(changes)
                     if len(self.maxChanges) > 0:
-                        changes = changes[:min(int(self.maxChanges), len(changes))]
+                        changes = itertools.islice(changes, int(self.maxChanges))
 
-                if len(changes) == 0:
+                # the changes are listed page by page while they are imported
+                changes = iter(changes)
+                try:
+                    firstChange = changes.next()
+                except StopIteration:
                     if not self.silent:
                         print "No changes to import!"
+                    self.cleanup()
                     return True
+                changes = itertools.chain([firstChange], changes)
+                if self.parallelImport > 1:
+                    changes = list(changes)
 
                 if not self.silent and not self.detectBranches:
                     print "Import destination: %s" % self.branch
 
-                self.updatedBranches = set()
                 # http://www.kerneltrap.com/mailarchive/git/2009/7/7/6203
                 # To restart an import, you need to use the from command in the
                 # first commit of that session, e.g. to restart an import on
                 # refs/heads/master use:
                 #
                 #  from refs/heads/master^0
-                self.importChanges(changes, self.restartImport)
+                if self.canImportInParallel(changes):
+                    self.importChangesInParallel(changes)
+                else:
+                    self.importChanges(changes, self.restartImport)
 
                 if not self.silent:
                     print ""
@@ -2472,26 +4321,36 @@ class P4Sync(Command):
                             sys.stdout.write("%s " % b)
                         sys.stdout.write("\n")
 
+            self.flushNotes()
             self.gitStream.flush()
 
         except IOError:
             self.cleanup()
             die("fast-import failed")
 
+        self.finishImport()
+        return True
+
+    def finishImport(self):
+        # Waits for fast-import to finish and cleans up.
+        # All authors are known by now; write the new users even if fast-import fails.
+        self.closeUserStore()
         if self.fileDump:
             print "Finished processing. Data may be manually utilized now (e.g. sent to git fast-import)"
         else:
-            if debugDumpFile:
-                debugDumpFile.close()
+            if self.debugDumpFile:
+                self.debugDumpFile.close()
 
-            importProcess.communicate()
+            self.importProcess.communicate()
+            refSnapshot.invalidate()
 
-            if importProcess.returncode != 0:
+            if self.importProcess.returncode != 0:
                 self.cleanup()
                 die("fast-import failed")
 
+            self.saveSyncState()
+
         self.cleanup()
-        return True
 
 class P4Rebase(P4Sync):
     def __init__(self):
@@ -2524,6 +4383,102 @@ class P4Rebase(P4Sync):
         system("git diff-tree --stat --summary -M %s HEAD" % oldHead)
         return True
 
+class P4Watch(P4Sync):
+    def __init__(self):
+        P4Sync.__init__(self)
+        self.options += [
+            optparse.make_option("--interval", dest="interval", type="float",
+                                 help="Seconds between two polls of the perforce server"),
+            optparse.make_option("--counter", dest="counter",
+                                 help="Only look for new changes when this p4 counter changed (e.g. 'change')"),
+            optparse.make_option("--max-polls", dest="maxPolls", type="int",
+                                 help="Stop after polling this many times (default: run until interrupted)"),
+        ]
+        self.description = ("Keeps importing new changes from perforce as they are submitted.\n"
+                            "Users, branch mappings, the client spec and git fast-import stay\n"
+                            "loaded between polls, so an idle poll costs one p4 command.")
+        self.interval = 1.0
+        if len(gitConfig("git-p4.watchInterval")) > 0:
+            self.interval = float(gitConfig("git-p4.watchInterval"))
+        self.counter = gitConfig("git-p4.watchCounter")
+        self.maxPolls = 0
+        self.counterValue = None
+
+    def latestChange(self):
+        # Returns the newest change in the depot paths, or None if the counter says
+        # nothing was submitted since the last poll.
+        if self.counter:
+            value = self.p4.p4Cmd("counter %s" % self.counter).get("value")
+            if value is not None and value == self.counterValue:
+                return None
+            self.counterValue = value
+        newest = 0
+        for entry in self.p4.p4CmdList("changes -m 1 -s submitted %s"
+                                       % ' '.join(['"%s..."' % p for p in self.depotPaths])):
+            if entry.has_key("change"):
+                newest = max(newest, int(entry["change"]))
+        return newest
+
+    def importNewChanges(self, latest):
+        if latest is None or latest <= self.lastImportedChange:
+            return
+
+        changes = [change for change in
+                   self.p4.p4ChangesForPaths(self.depotPaths, "@%s,#head" % (self.lastImportedChange + 1))
+                   if change > self.lastImportedChange]
+        if len(changes) == 0:
+            return
+
+        self.importChanges(changes)
+        # the checkpoint updates the refs and notes
+        self.checkpoint()
+        self.lastImportedChange = changes[-1]
+        # a sync after the watch ended, however it ended, continues from here
+        self.saveSyncState()
+        if self.userStore is not None:
+            self.userStore.flush()
+        if not self.silent:
+            print "Imported changes %s to %s" % (changes[0], changes[-1])
+
+    def abortImport(self):
+        # Like a failed sync, nothing still buffered is passed on to fast-import; the
+        # refs keep the state of the last checkpoint.
+        if self.importProcess is not None:
+            self.importProcess.kill()
+            self.importProcess.wait()
+        self.cleanup()
+
+    def run(self, args):
+        revision = self.prepareImport(args)
+        if revision:
+            die("Nothing has been imported yet, use git-p4 sync or clone first")
+
+        polls = 0
+        try:
+            while True:
+                try:
+                    if polls > 0:
+                        time.sleep(self.interval)
+                    latest = self.latestChange()
+                except KeyboardInterrupt:
+                    # nothing is being imported while waiting
+                    break
+                self.importNewChanges(latest)
+                polls += 1
+                if self.maxPolls > 0 and polls >= self.maxPolls:
+                    break
+            self.flushNotes()
+            self.gitStream.flush()
+        except IOError:
+            self.cleanup()
+            die("fast-import failed")
+        except KeyboardInterrupt:
+            self.abortImport()
+            die("Interrupted while importing, changes up to %s have been imported" % self.lastImportedChange)
+
+        self.finishImport()
+        return True
+
 class P4Clone(P4Sync):
     def __init__(self):
         P4Sync.__init__(self)
@@ -2699,8 +4654,7 @@ class P4Shelve(P4Submit):
             self.existingClNumber = self.clnumber
 
         # Add files to changelist
-        diffOpts = ("", "-M")[self.detectRename]
-        diffOpts = (diffOpts, "-C")[self.detectCopy]
+        diffOpts = self.diffOptions()
 
         self.filesToAdd = set()
         self.filesToDelete = set()
@@ -2765,6 +4719,7 @@ commands = {
     "commit" : P4Submit,
     "sync" : P4Sync,
     "rebase" : P4Rebase,
+    "watch" : P4Watch,
     "clone" : P4Clone,
     "rollback" : P4RollBack,
     "branches" : P4Branches, 
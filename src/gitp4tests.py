@@ -4,8 +4,9 @@
 
 import unittest
 import StringIO
-import time, tempfile, shutil, shlex, subprocess, os
-from gitp4 import P4Sync, P4FileReader, extractSettingsFromNotes, P4Helper, die
+import time, tempfile, shutil, shlex, subprocess, os, re
+from gitp4 import P4Sync, P4FileReader, extractSettingsFromNotes, P4Helper, die, kKeywords, koKeywords, P4BinaryPolicy, defaultBinaryPolicy, ProgressReporter, DepotPathMatcher
+from gitp4 import escapeStringP4, escapeStringP4only, isWindows, refSnapshot
 
 class LargeFileWriterDouble:
     def __init__(self):
@@ -36,9 +37,12 @@ class P4HelperDouble(P4Helper):
         if cmd in self.cmds:
             return self.cmds[cmd]
         return P4Helper.p4CmdList(cmd, stdin, stdin_mode)
+
+    def p4CmdStream(self, cmd, stdin=None, stdin_mode='w+b', failOnError=True):
+        return iter(self.p4CmdList(cmd, stdin, stdin_mode))
         
 class P4FileReaderDouble(P4FileReader):
-    def __init__(self, files, clientSpecDirs):
+    def __init__(self, files, clientSpecDirs, binaryPolicy=None, progress=None, binaryStore=None):
         P4FileReader.__init__(self,  [],  [])
         self.reader = None
         self.files = files
@@ -67,7 +71,11 @@ class P4FileReaderDouble(P4FileReader):
         return f
 
 class TestSubmit(unittest.TestCase):
-    
+
+    def setUp(self):
+        # the tests change into new repositories with os.chdir
+        refSnapshot.invalidate()
+
     def test_WriteFastImport(self):
         tempdir = tempfile.mkdtemp()
         os.chdir(tempdir)
@@ -87,7 +95,7 @@ class TestSubmit(unittest.TestCase):
                 'type0': 'text', 
                 'change': '33255', 
                 'digest0': 'BDA001AC8DE4B3B0484FE8252FEE73E8'}
-            files = [{'action': 'edit', 'path': '//depot/file.py', 'rev': '10', 'type': 'text'}]
+            files = [{'action': 'edit', 'path': '//depot/file.py', 'rev': '10', 'type': 'text', 'targetPath': '//depot/file.py'}]
             branch = 'refs/remotes/p4/master'
             branchPrefixes = ['//depot/']
             parent = '3f641bec8f633e294a954d1a1d13b32e61232699'
@@ -100,6 +108,7 @@ class TestSubmit(unittest.TestCase):
             sync.labels = {}
             
             sync.commit(details, files, branch, branchPrefixes, parent)
+            sync.flushNotes()
             actual = sync.gitStream.getvalue()
             self.assertEqual('''commit refs/remotes/p4/master
 mark :1
@@ -115,7 +124,6 @@ data 9
 some text
 
 commit refs/notes/git-p4
-mark :2
 committer <someuser@example.com> 1289238991 %s
 data 28
 Note added by git-p4 import
@@ -271,7 +279,10 @@ some text
             shutil.rmtree(tempdir,  True)
 
 class TestSync(unittest.TestCase):
-    
+
+    def setUp(self):
+        refSnapshot.invalidate()
+
     # tests syncing with a p4 change when the git repo (with older p4 changes) was already imported
     def test_SyncWithExistingRepo(self):
         tempdir = tempfile.mkdtemp()
@@ -471,6 +482,108 @@ EOT
         finally:
             shutil.rmtree(tempdir,  True)
 
+class TestKeywords(unittest.TestCase):
+
+    def test_CollapseKeywordsSplitAcrossChunks(self):
+        text = "/* $Id: //depot/main/a.c#3 $ */\n$Author: bob $ costs $5\n$Header: x $"
+        for keywords in (kKeywords, koKeywords):
+            expected = keywords.collapse(text)
+            for size in range(1, len(text) + 1):
+                collapser = keywords.collapser()
+                chunks = [collapser.feed(text[i:i + size]) for i in range(0, len(text), size)]
+                self.assertEqual(expected, ''.join(chunks) + collapser.flush())
+
+        self.assertEqual("/* $Id$ */\n$Author$ costs $5\n$Header$", kKeywords.collapse(text))
+        self.assertEqual("/* $Id$ */\n$Author: bob $ costs $5\n$Header$", koKeywords.collapse(text))
+
+    def test_UnterminatedKeywordIsNotHeldBack(self):
+        text = "$Id: " + "x" * 10000 + "\n" * 10000 + "$Id: y $"
+        collapser = koKeywords.collapser()
+        chunks = []
+        for i in range(0, len(text), 100):
+            chunks.append(collapser.feed(text[i:i + 100]))
+            self.assertTrue(len(collapser.pending) <= koKeywords.maxValueLength + 100)
+        self.assertEqual(koKeywords.collapse(text), ''.join(chunks) + collapser.flush())
+        self.assertTrue(koKeywords.collapse(text).endswith("$Id$"))
+
+class TestBinaryPolicy(unittest.TestCase):
+
+    def test_FirstMatchingRuleDecides(self):
+        policy = P4BinaryPolicy(["include *.PNG", "exclude *.png", "exclude //depot/art/*",
+                                 "include type:ubinary", "exclude size>1k", "include *.psd"])
+        self.assertTrue(policy.includes("//depot/ui/icon.png", "binary"))
+        self.assertFalse(policy.includes("//depot/art/icon.psd", "binary"))
+        self.assertTrue(policy.includes("//depot/ui/setup.exe", "ubinary", "5000"))
+        self.assertFalse(policy.includes("//depot/ui/setup.exe", "binary", "5000"))
+        self.assertTrue(policy.includes("//depot/ui/setup.exe", "binary", "1000"))
+        # without a size, size conditions don't match
+        self.assertTrue(policy.includes("//depot/ui/setup.exe", "binary"))
+
+    def test_DefaultPolicyKeepsTiffSuffix(self):
+        policy = P4BinaryPolicy(defaultBinaryPolicy)
+        self.assertTrue(policy.includes("//depot/ui/scan.TIFF", "binary"))
+        self.assertTrue(policy.includes("//depot/ui/scan_tiff", "binary"))
+        self.assertFalse(policy.includes("//depot/ui/scan.tiffx", "binary"))
+
+class TerminalDouble(StringIO.StringIO):
+    def isatty(self):
+        return True
+
+class TestProgressReporter(unittest.TestCase):
+
+    def test_RedrawsOnlyAfterInterval(self):
+        terminal = TerminalDouble()
+        progress = ProgressReporter(interval=3600, stream=terminal)
+        progress.startPhase("Importing changes", 4)
+        progress.changeDone(1)
+        progress.changeDone(2)
+        self.assertEqual(terminal.getvalue().count("\r"), 1)
+        progress.finish()
+        self.assertTrue("2/4 changes" in terminal.getvalue())
+        self.assertTrue(terminal.getvalue().endswith("\n"))
+
+        log = StringIO.StringIO()
+        progress = ProgressReporter(interval=0, stream=log)
+        progress.changeDone(1)
+        progress.finish()
+        self.assertEqual(log.getvalue(), "")
+        self.assertEqual(progress.changes, 1)
+
+class TestDepotPathMatcher(unittest.TestCase):
+
+    def test_FirstPrefixWinsAndPathIsDecoded(self):
+        matcher = DepotPathMatcher(["//depot/a/", "//depot/a/b/", "//depot/c+d/"], ["//depot/a/tmp/"])
+        self.assertEqual(matcher.match("//depot/a/b/x.txt"), ("//depot/a/", "b/x.txt"))
+        self.assertEqual(matcher.match("//depot/c+d/50%25/file%40home"), ("//depot/c+d/", "50%/file@home"))
+        self.assertEqual(matcher.match("//depot/a/tmp/x.txt"), None)
+        self.assertEqual(matcher.match("//depot/cd/x.txt"), None)
+        self.assertTrue(matcher.matches("//depot/c+d/x"))
+
+class TestEscaping(unittest.TestCase):
+
+    def test_EscapeP4Wildcards(self):
+        self.assertEqual(escapeStringP4only("a/50%@x#1*.txt"), "a/50%25%40x%231%2A.txt")
+        self.assertEqual(escapeStringP4only("a/plain.txt"), "a/plain.txt")
+        if not isWindows:
+            self.assertEqual(escapeStringP4("a/$b@2"), "a/\\$b%402")
+
+class SparseChangesDouble(P4Helper):
+    def __init__(self, changes):
+        self.changes = changes
+        self.queries = 0
+
+    def p4CmdStream(self, cmd, stdin=None, stdin_mode='w+b', failOnError=True):
+        (low, high) = [int(n) for n in re.search(r"@(\d+),@(\d+)", cmd).groups()]
+        self.queries += 1
+        return iter([{'change': str(c)} for c in reversed(self.changes) if low <= c <= high])
+
+class TestChangesPaged(unittest.TestCase):
+
+    def test_SparseWindowGrowsWithTinyPageSize(self):
+        p4 = SparseChangesDouble([1, 2, 1000])
+        self.assertEqual(list(p4.p4ChangesPaged("//depot/", 1, 1000, 1)), [1, 2, 1000])
+        self.assertTrue(p4.queries < 30)
+
 if __name__ == '__main__':
     unittest.main()
 